@@ -1,6 +1,28 @@
-from sympy import Symbol
-from math import sin,cos,tan,log,exp
-import turtle
+"""Expression trees: parsing, printing, simplification, differentiation and evaluation of mathematical expressions.
+
+Concurrency: trees are immutable and interned, and the module caches are locked, so one tree can be shared by any number
+of threads or asyncio tasks. All Expression methods are safe to call concurrently; they return new trees or numbers and
+only fill in caches, which any thread may fill. Not to be shared between threads without a lock of your own: Evaluator
+(update() changes its values), Polynomial.evaluate() on the first call, and enabling or disabling instrumentation. From
+asyncio code, AsyncTrees runs the heavy operations (diff, simplify, ...) in an executor so the event loop is not blocked.
+"""
+from math import sin,cos,tan,log,exp,isfinite,ceil,pi,inf,nextafter
+import functools
+import itertools
+import keyword
+import mmap
+import operator
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import warnings
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from fractions import Fraction
 
 precedence = { # Dictionary of operators with corresponding presedence
         '+' : 2,
@@ -27,55 +49,278 @@ associativity = { # Dictionary of operators with corresponding associativity
 oplist = ['+','-','*','/','%','**','^','(',')'] # list of operators to use when to check if element/node is an operator
 flist = ['sin','cos','tan','log','exp']         # list of functions to use when to check if element/node is a function
 
-# split string into list with appropriate attributes for operators
-def tokenize(string):
-    #1) split string into constants and operators
-    tokenstring = []
-    for c in string:
-        if c in oplist:
-            tokenstring.append(' %s ' % c)
-        elif c == ' ':
+operators = { # Dictionary of binary operators with the function used to fold constants
+        '+' : operator.add,
+        '-' : operator.sub,
+        '*' : operator.mul,
+        '/' : operator.truediv,
+        '**': operator.pow,
+        '^' : operator.xor,
+        }
+
+mathfuncs = { # Dictionary of function names with the implementation used by compiled trees
+        'sin' : sin,
+        'cos' : cos,
+        'tan' : tan,
+        'log' : log,
+        'exp' : exp,
+        }
+
+# make a constant node for a number, negative numbers become a negation of a constant
+def constant(c):
+    if isinstance(c, bool) or not isinstance(c, (int, float)):
+        raise TypeError('Not a real number: %r' % (c,))
+    if isfinite(c) and c == int(c):
+        c = int(c)
+    if c < 0:
+        return NegNode(Constant(-c))
+    return Constant(c)
+
+# return the number a (simplified) node stands for, or None if it is not constant
+def constvalue(node):
+    if type(node) == Constant:
+        return node.content
+    if type(node) == NegNode and type(node.lhs) == Constant:
+        return -node.lhs.content
+    if not isinstance(node, Expression):
+        return node
+    return None
+
+# the value of a tree without variables when it is a whole number, as evaluate() computes it (its interval has been widened)
+def integervalue(node):
+    if isinstance(node, Expression):
+        if node.variables():
+            return None
+        try:
+            node = node.evaluate()
+        except (ArithmeticError, ValueError):
+            return None
+    if isinstance(node, int) or (isinstance(node, float) and node.is_integer()):
+        return int(node)
+    return None
+
+# widen an interval by one unit in the last place on both sides, so that it contains the exact result of a rounded operation
+def outward(lo, hi):
+    return (nextafter(lo, -inf), nextafter(hi, inf))
+
+# the bounds of a sum of two intervals
+def addbounds(a, b):
+    return outward(a[0] + b[0], a[1] + b[1])
+
+# the bounds of a product of two intervals; 0 * inf counts as 0
+def mulbounds(a, b):
+    products = [x * y if x and y else 0.0 for x in a for y in b]
+    return outward(min(products), max(products))
+
+# x ** y, infinite instead of OverflowError
+def power(x, y):
+    try:
+        return x ** y
+    except OverflowError:
+        return -inf if x < 0 and y % 2 == 1 else inf
+
+# exp(x), infinite instead of OverflowError
+def exponential(x):
+    try:
+        return exp(x)
+    except OverflowError:
+        return inf
+
+# the bounds of sin or cos (f, with its maxima at top + 2k*pi) over [lo, hi]: the values at the ends, unless a maximum or
+# minimum lies in between; the ends are evaluated as given, top is only used to find the extrema
+def periodicbounds(f, top, lo, hi):
+    if hi - lo >= 2 * pi:
+        return (-1.0, 1.0)
+    low, high = outward(min(f(lo), f(hi)), max(f(lo), f(hi)))
+    if top + 2 * pi * ceil((lo - top) / (2 * pi)) <= hi:
+        high = 1.0
+    if top - pi + 2 * pi * ceil((lo - top + pi) / (2 * pi)) <= hi:
+        low = -1.0
+    return (max(low, -1.0), min(high, 1.0))
+
+class DomainError(ValueError):
+    """Raised when an expression is not defined for (part of) the given values, such as a division by zero or log(0)"""
+
+class ParseError(ValueError):
+    """Raised for malformed expression strings, pos is the offset of the offending character"""
+    def __init__(self, message, pos):
+        super(ParseError, self).__init__('%s at position %d' % (message, pos))
+        self.pos = pos
+
+
+lexpattern = re.compile(r'(?P<space>\s+)|(?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?![^-+*/%^()\s])'   # a number may not run into a word, 2x is an error
+                        r'|(?P<op>\*\*|[-+*/%^()])|(?P<word>[^-+*/%^()\s]+)')
+
+# return '+' or '*' for nodes of an associative and commutative operator (binary or n-ary), else None
+def family(node):
+    if isinstance(node, (BinaryNode, NaryNode)) and (node.content == '+' or node.content == '*'):
+        return node.content
+    return None
+
+# return the operands of a chain of + or * nodes, e.g. a, b, c for (a + b) + c
+def flatoperands(node):
+    result, stack = [], [node]
+    while stack:
+        n = stack.pop()
+        if family(n) == node.content:
+            stack.extend(n.children())
+        else:
+            result.append(n)
+    return result
+
+# compare two trees in a deterministic total order: constants, then variables, then other nodes by type and children;
+# the trees are walked side by side with a stack, as deep trees would overflow a recursive comparison
+def treecompare(a, b):
+    stack = [(a, b)]
+    while stack:
+        item = stack.pop()
+        if len(item) == 3:                      # the numbers of children, compared after the children themselves
+            if item[1] != item[2]:
+                return -1 if item[1] < item[2] else 1
             continue
-        else: 
-            tokenstring.append(c)
-    tokenstring = ''.join(tokenstring)
-    stringlist = tokenstring.split() 
-    
-    #2) additional case for multiple letter operators
-    ans = []    
-    for t in stringlist:
-        if len(ans) > 0 and t == ans[-1] == '*':
-            ans[-1] = '**'
-
-        elif len(ans) > 2 and t == '(' and ans[-1] in flist:
-            ans.append(t)
+        a, b = item
+        while a is not b and type(a) == type(b) and isinstance(a, (Function, UnaryNode)):
+            a, b = a.lhs, b.lhs                 # runs of the same function, e.g. sin(sin(...)), are walked without the stack
+        if a is b:
+            continue
+        heads = []
+        for node in (a, b):
+            if type(node) == Constant or not isinstance(node, Expression):
+                heads.append((0, node.content if isinstance(node, Expression) else node))
+            elif type(node) == Variable:
+                heads.append((1, str(node.content)))
+            else:
+                heads.append((2, type(node).__name__))
+        if heads[0] != heads[1]:
+            return -1 if heads[0] < heads[1] else 1
+        if heads[0][0] == 2:
+            ca, cb = a.children(), b.children()
+            stack.append((None, len(ca), len(cb)))
+            stack.extend(reversed(list(zip(ca, cb))))
+    return 0
+
+sortkey = functools.cmp_to_key(treecompare)    # key giving the order of treecompare, used to sort the operands of n-ary nodes
+
+# split a canonical term into its numeric coefficient and the rest, e.g. - 2 * x * y into -2 and x * y
+def coefficient(term):
+    if type(term) == NegNode:
+        c, rest = coefficient(term.lhs)
+        return -c, rest
+    if type(term) == ProductNode and type(term.operands[0]) == Constant:
+        factors = term.operands[1:]
+        return term.operands[0].content, factors[0] if len(factors) == 1 else ProductNode(*factors)
+    return 1, term
+
+# multiply a canonical term by a numeric coefficient, the inverse of coefficient()
+def scaled(c, rest):
+    if c == 1:
+        return rest
+    if c == -1:
+        return NegNode(rest)
+    factors = rest.operands if type(rest) == ProductNode else (rest,)
+    result = ProductNode(constant(abs(c)), *factors)
+    return NegNode(result) if c < 0 else result
+
+# c * rest (or just c), as (p * rest) / q when c is a Fraction p/q
+def rational(c, rest=None):
+    if type(c) != Fraction:
+        return constant(c) if rest is None else scaled(c, rest)
+    result = DivNode(Constant(abs(c.numerator)) if rest is None else scaled(abs(c.numerator), rest), Constant(c.denominator))
+    return NegNode(result) if c < 0 else result
+
+# collect the terms of a chain of +, - and negation into a canonical SumNode, merging like terms
+def collectsum(root, canon):
+    terms, const = {}, 0
+    stack = [(root, 1)]
+    while stack:
+        node, sign = stack.pop()
+        if node is not root and family(node) != '+' and isinstance(node, Expression):
+            node = canon(node)
+        if family(node) == '+':
+            stack.extend((c, sign) for c in node.children())
+        elif type(node) == SubNode:
+            stack.extend([(node.lhs, sign), (node.rhs, -sign)])
+        elif type(node) == NegNode and constvalue(node) is None:
+            stack.append((node.lhs, -sign))
+        elif constvalue(node) is not None:
+            const += sign * constvalue(node)
         else:
-            ans.append(t)
-            
-    #3) classify 
-    tokens = []
-    prev = None
-    for i in ans:
-        
-        if ((prev != ')' and prev in oplist) or prev == None) and i == '-':
-            tokens.append(('neg','#'))    # if negation -
-        elif len(i)>1 and i in flist:
-            tokens.append(('func',i))     # if function
-        elif i == '(':
-            tokens.append(('leftp',i))    # if parenthesis
-        elif i == ')':
-            tokens.append(('rightp',i))   # if parenthesis
-        elif i in oplist:
-            tokens.append(('oper', i))    # if operator
-        elif isnumber(i):
-            tokens.append(('num', i))     # if constant
-        else: 
-            tokens.append(('var', i))     # if variable
-        prev = i
-            
-    return tokens
+            c, rest = coefficient(node)
+            terms[rest] = terms.get(rest, 0) + sign * c
+    result = [scaled(c, rest) for rest, c in sorted(terms.items(), key=lambda t: sortkey(t[0])) if c != 0]
+    if const != 0 or not result:
+        result.append(constant(const))      # the constant term goes last
+    return result[0] if len(result) == 1 else SumNode(*result)
+
+# collect the factors of a chain of * into a canonical ProductNode, merging constants and powers of the same base
+def collectproduct(root, canon):
+    powers, coef = {}, 1
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node is not root and family(node) != '*' and isinstance(node, Expression):
+            node = canon(node)
+        if type(node) == NegNode and constvalue(node) is None:
+            coef = -coef
+            node = node.lhs
+        if family(node) == '*':
+            stack.extend(node.children())
+        elif constvalue(node) is not None:
+            coef *= constvalue(node)
+        elif type(node) == PowNode and constvalue(node.rhs) is not None:
+            powers[node.lhs] = powers.get(node.lhs, 0) + constvalue(node.rhs)
+        else:
+            powers[node] = powers.get(node, 0) + 1
+    if coef == 0:
+        return Constant(0)
+    factors = []
+    for base, e in sorted(powers.items(), key=lambda t: sortkey(t[0])):
+        if e == 1:
+            factors.append(base)
+        elif e != 0:
+            factors.append(PowNode(base, constant(e)))
+    if not factors:
+        return constant(coef)
+    result = factors[0] if len(factors) == 1 else ProductNode(*factors)
+    if coef == -1 and family(result) == '+':
+        return collectsum(NegNode(result), canon)   # - (x + y) is canonical as - x - y, as when it is written that way
+    return scaled(coef, result)
+
+# split string into (kind, value, position) tokens in a single pass
+def lex(string):
+    prev = None                                 # kind of the previous token, to recognise negation
+    for m in lexpattern.finditer(string):
+        kind = m.lastgroup
+        value = m.group()
+        if kind == 'space':
+            continue
+        if kind == 'num':
+            pass                                # if constant
+        elif kind == 'word':
+            if not value.isidentifier():
+                raise ParseError('Invalid name %s' % value, m.start())       # 2x, 1e-, $
+            elif isnumber(value):
+                raise ParseError('Non-finite number %s' % value, m.start())  # inf and nan are neither constants nor variables
+            elif value in flist:
+                kind = 'func'                   # if function
+            else:
+                kind = 'var'                    # if variable
+        elif value == '(':
+            kind = 'leftp'
+        elif value == ')':
+            kind = 'rightp'
+        elif value == '-' and prev in (None, 'oper', 'neg', 'leftp'):
+            kind, value = 'neg', '#'            # if negation -
+        else:
+            kind = 'oper'
+        yield kind, value, m.start()
+        prev = kind
+
+# split string into list with appropriate attributes for operators
+def tokenize(string):
+    return [(kind, value) for kind, value, pos in lex(string)]
+
 
-    
 # check if a string represents a numeric value
 def isnumber(string):
     try:
@@ -93,8 +338,529 @@ def isint(string):
         return False
     
 
-class Expression():
-    """A mathematical expression, represented as an expression tree"""
+# yield the distinct nodes of a tree, children before parents, with an explicit stack instead of recursion
+def postorder(tree, skip=None):
+    seen = set()
+    stack = [tree]
+    while stack:
+        node = stack[-1]
+        if id(node) in seen:                    # shared node pushed by more than one parent
+            stack.pop()
+            continue
+        pending = [c for c in node.children() if isinstance(c, Expression) and id(c) not in seen and not (skip and skip(c))]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        seen.add(id(node))
+        yield node
+    if instrumentation.enabled:
+        instrumentation.count('nodes visited', len(seen))
+
+# the distinct nodes of a tree in postfix order with the positions of their children, cached in tapecache
+def tape(tree):
+    cached = tapecache.getnode(tree)
+    if cached is not None:
+        return cached
+    nodes, arguments, position = [], [], {}
+    for node in postorder(tree):
+        args = []
+        for c in node.children():
+            if not isinstance(c, Expression):   # a plain number as child becomes a constant leaf of the tape
+                c = Constant(c)
+                if id(c) not in position:
+                    position[id(c)] = len(nodes)
+                    nodes.append(c)
+                    arguments.append(())
+            args.append(position[id(c)])
+        position[id(node)] = len(nodes)
+        nodes.append(node)
+        arguments.append(tuple(args))
+    tapecache.putnode(tree, (nodes, arguments))
+    return nodes, arguments
+
+# the value of every node on the tape for the values of the variables in d
+def tapevalues(nodes, arguments, d):
+    values = [None] * len(nodes)
+    for i, node in enumerate(nodes):
+        if type(node) == Variable:
+            values[i] = d[node.content]
+        elif type(node) == Constant:
+            values[i] = node.content
+        else:
+            values[i] = node._apply(*[values[j] for j in arguments[i]])
+    return values
+
+# generate the source of a straight-line Python function computing the tree, every distinct subtree is computed once;
+# params are the argument names (default v0, v1, ...), module the prefix of the function calls, e.g. 'math.'
+def codegen(tree, vars, namespace, function='_compiled', params=None, module=''):
+    args = {}
+    for i, var in enumerate(vars):
+        args[var] = params[i] if params is not None else 'v%d' % i
+    temp = 't'
+    while any(arg.startswith(temp) for arg in args.values()):
+        temp = '_' + temp
+    names = {}                                  # id(node) -> local name or literal holding its value
+    lines = []
+    def name(node):
+        if id(node) in names:
+            return names[id(node)]
+        value = node.content if isinstance(node, Expression) else node
+        if isinstance(value, (int, float)) and isfinite(value):
+            return repr(value) if value >= 0 else '(%r)' % value
+        if namespace is None:                   # standalone source: values without a literal form (inf, nan) are written as calls
+            return "float('%r')" % value
+        names[id(node)] = 'c%d' % len(names)    # values without a literal form (inf, nan) are passed in the namespace
+        namespace[names[id(node)]] = value
+        return names[id(node)]
+    for node in postorder(tree):                # shared nodes are computed once
+        if type(node) == Constant:
+            continue
+        elif type(node) == Variable:
+            if str(node.content) not in args:
+                raise ValueError('Unbound variable: %s' % node.content)
+            names[id(node)] = args[str(node.content)]
+            continue
+        if isinstance(node, BinaryNode):
+            line = '%s %s %s' % (name(node.lhs), node.content, name(node.rhs))
+        elif isinstance(node, NaryNode):
+            line = (' %s ' % node.content).join(name(c) for c in node.operands)
+        elif isinstance(node, Function):
+            line = '%s%s(%s)' % (module, node.content, name(node.lhs))
+        else:
+            line = '%s%s' % (node.content, name(node.lhs))
+        names[id(node)] = '%s%d' % (temp, len(lines))
+        lines.append('%s = %s' % (names[id(node)], line))
+    lines.append('return %s' % name(tree))
+    return 'def %s(%s):\n    %s\n' % (function, ', '.join(args[var] for var in vars), '\n    '.join(lines))
+
+
+# place a tree for drawing in linear time: breadth first, at most limit nodes are expanded and the rest is collapsed into
+# one item per subtree; leaves get consecutive x positions from left to right and parents are centered over their children,
+# so nothing overlaps. Returns a list of (label, kind, x, depth, parent index) with parents before their children
+def treelayout(tree, limit=1000):
+    sizes = {}                                  # id(node) -> number of nodes when drawn as a tree (shared subtrees repeated)
+    for node in postorder(tree):
+        sizes[id(node)] = 1 + sum([sizes[id(c)] if isinstance(c, Expression) else 1 for c in node.children()])
+    items, children = [], []
+    queue = deque([(tree, None, 0)])
+    while queue:
+        node, parent, depth = queue.popleft()
+        if parent is not None:
+            children[parent].append(len(items))
+        kids = node.children() if isinstance(node, Expression) else ()
+        if kids and len(items) + len(queue) + 1 + len(kids) > limit:
+            label, kind = '... (%d nodes)' % sizes[id(node)], 'collapsed'
+            kids = ()
+        elif type(node) == Variable:
+            label, kind = str(node.content), 'variable'
+        elif not kids:
+            label, kind = str(node.content if isinstance(node, Expression) else node), 'constant'
+        elif isinstance(node, Function):
+            label, kind = node.content, 'function'
+        else:
+            label, kind = node.content, 'operator'
+        items.append([label, kind, 0, depth, parent])
+        children.append([])
+        queue.extend((c, len(items) - 1, depth + 1) for c in kids)
+    x = 0
+    stack = [0]
+    while stack:                                # depth first from the left, so the leaves are met in order
+        i = stack.pop()
+        if children[i]:
+            stack.extend(reversed(children[i]))
+        else:
+            items[i][2] = x
+            x += 1
+    for i in range(len(items) - 1, -1, -1):     # breadth first order reversed: children before parents
+        if children[i]:
+            items[i][2] = (items[children[i][0]][2] + items[children[i][-1]][2]) / 2.0
+    return [tuple(item) for item in items]
+
+treecolours = {'operator': 'Black', 'function': 'Green', 'variable': 'Red', 'constant': 'Blue', 'collapsed': 'Gray'}
+
+
+class LRUCache():
+    """A bounded, thread-safe mapping that drops the least recently used entry when full, counting hits and misses"""
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def getnode(self, node, extra=None, default=None):
+        " Returns the value putnode stored for node (and extra), keyed by id(node) "
+        entry = self.get((id(node), extra))
+        if entry is not None and entry[0] is node:  # the entry holds the node, so its id can't have been reused
+            return entry[1]
+        return default
+
+    def putnode(self, node, value, extra=None):
+        " Stores value for node (and extra), together with node itself to keep it alive "
+        self.put((id(node), extra), (node, value))
+
+    def resize(self, maxsize):
+        " Changes the maximum number of entries, dropping the oldest ones if needed "
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        " Drops all entries and resets the counters "
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class Instrumentation():
+    """Opt-in counters and timings of the tree operations; while disabled the operations are not wrapped and every
+    counter is a single test of enabled"""
+    operations = ['fromString', 'parse', 'diff', 'simplify', 'substitute', 'compile', 'evaluate', 'evaluate_batch',
+                  'derivative_at', 'gradient_at', 'bounds', 'encode', 'cse']
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}                      # (operation, counter) -> count, operation is the outermost one running
+        self.timings = {}                       # operation -> [calls, seconds]
+        self._lock = threading.Lock()
+        self._local = threading.local()         # the outermost operation running in each thread
+        self._originals = {}
+
+    def enable(self):
+        " Starts counting, and timing the methods of Expression listed in operations "
+        if not self.enabled:
+            for name in self.operations:
+                self._originals[name] = Expression.__dict__[name]
+                setattr(Expression, name, self._timed(name, self._originals[name]))
+            self.enabled = True
+
+    def disable(self):
+        " Stops counting and puts back the unwrapped methods; the results are kept "
+        if self.enabled:
+            self.enabled = False
+            for name, f in self._originals.items():
+                setattr(Expression, name, f)
+            self._originals.clear()
+
+    def reset(self):
+        " Sets all counters and timings back to zero "
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+    def _timed(self, name, f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            outer = getattr(self._local, 'operation', None)
+            if outer is None:
+                self._local.operation = name
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                if outer is None:
+                    self._local.operation = None
+                self.record(name, start)
+        return wrapper
+
+    def count(self, name, n=1):
+        " Adds n to a counter of the operation that is running "
+        if self.enabled:
+            key = (getattr(self._local, 'operation', None), name)
+            with self._lock:
+                self.counters[key] = self.counters.get(key, 0) + n
+
+    def record(self, name, start):
+        " Adds a call taking the time since start (a time.perf_counter() value) to the timing of name "
+        if self.enabled:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                timing = self.timings.setdefault(name, [0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+
+    def snapshot(self):
+        " Returns the counters, timings and cache statistics as a dict "
+        with self._lock:
+            operations = {}
+            for name, (calls, seconds) in self.timings.items():
+                operations[name] = {'calls': calls, 'seconds': seconds}
+            for (name, counter), n in self.counters.items():
+                operations.setdefault(name or 'other', {})[counter] = n
+        caches = {'parsecache': parsecache, 'diffcache': diffcache, 'tapecache': tapecache, 'specializecache': specializecache}
+        return {'operations': operations, 'caches': {name: cache.info() for name, cache in caches.items()}}
+
+    def report(self):
+        " Returns the snapshot as readable text, one line per operation and per cache "
+        snapshot = self.snapshot()
+        lines = []
+        for name, values in sorted(snapshot['operations'].items()):
+            parts = ['%d calls, %.6f s' % (values['calls'], values['seconds'])] if 'calls' in values else []
+            parts.extend('%s %d' % (counter, n) for counter, n in sorted(values.items()) if counter not in ('calls', 'seconds'))
+            lines.append('%-16s %s' % (name, ', '.join(parts)))
+        for name, info in sorted(snapshot['caches'].items()):
+            lines.append('%-16s %d hits, %d misses, %d of %d entries' % (name, info['hits'], info['misses'], info['size'], info['maxsize']))
+        return '\n'.join(lines)
+
+
+instrumentation = Instrumentation()     # opt-in profiling of the tree operations, see Instrumentation
+
+
+fixpoint = object()                     # marker in _simplified, _canonical and _expanded: the node is its own result; a reference to itself would be a cycle
+
+workerfunction = None                   # the compiled tree inside a worker process of Expression.evaluate_many
+
+def startworker(source, constants):
+    global workerfunction
+    namespace = dict(mathfuncs)
+    namespace.update(constants)
+    exec(source, namespace)
+    workerfunction = namespace['_compiled']
+
+def evaluatechunk(rows):
+    return [workerfunction(*row) for row in rows]
+
+
+class Interned(type):
+    """Metaclass that hash-conses nodes: constructing a node equal to a live one returns that same object"""
+    table = weakref.WeakValueDictionary()
+    lock = threading.Lock()                     # only taken to add a node, so two threads can't make the same node twice
+
+    def __call__(cls, *args):
+        # children are keyed by identity; a live node keeps its children alive, so their ids cannot be reused
+        key = (cls,) + tuple(id(a) if isinstance(a, Expression) else (type(a), a) for a in args)
+        node = Interned.table.get(key)
+        if node is None:
+            with Interned.lock:
+                node = Interned.table.get(key)  # another thread may have made it in the meantime
+                if node is None:
+                    node = super(Interned, cls).__call__(*args)
+                    Interned.table[key] = node
+            if instrumentation.enabled:
+                instrumentation.count('nodes allocated')
+        elif instrumentation.enabled:
+            instrumentation.count('nodes reused')
+        return node
+
+
+class Expression(metaclass=Interned):
+    """A mathematical expression, represented as an immutable expression tree"""
+    __slots__ = ('lhs', 'rhs', 'operands', 'content', '_hash', '_acc', '_compiled', '_simplified', '_canonical',
+                 '_expanded', '_variables', '__weakref__')
+
+    def _init(self, lhs, rhs, content, h, operands=None):
+        " Sets the fields of a new node; afterwards the node can not be changed "
+        object.__setattr__(self, 'lhs', lhs)
+        object.__setattr__(self, 'rhs', rhs)
+        object.__setattr__(self, 'operands', operands)
+        object.__setattr__(self, 'content', content)
+        if (content == '+' or content == '*') and (operands is not None or rhs is not None):    # hash of a + or * chain only depends on the multiset of its operands
+            acc = 0
+            for c in (operands if operands is not None else (lhs, rhs)):
+                acc += c._acc if family(c) == content else hash(c)
+            object.__setattr__(self, '_acc', acc & 0xFFFFFFFFFFFFFFFF)
+            h = hash((content, self._acc))
+        else:
+            object.__setattr__(self, '_acc', None)
+        object.__setattr__(self, '_hash', h)
+        object.__setattr__(self, '_canonical', None)
+        object.__setattr__(self, '_compiled', None)
+        object.__setattr__(self, '_simplified', None)
+        object.__setattr__(self, '_expanded', None)
+        object.__setattr__(self, '_variables', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Expression trees are immutable, build a new tree instead')
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):        # identical trees are the same object, so only hash collisions and reordered +/* need a full comparison
+        stack = [(self, other)]
+        while stack:
+            a, b = stack.pop()
+            if a is b:
+                continue
+            if isinstance(a, Expression) != isinstance(b, Expression):     # a tree never equals a plain value; a != b would call this method again
+                return False
+            if not isinstance(a, Expression):
+                if a != b:
+                    return False
+                continue
+            if a._hash != b._hash:
+                return False
+            if family(a) is not None:       # + and * are compared as multisets of operands, in any order or grouping
+                if family(a) != family(b):
+                    return False
+                lhs, rhs = sorted(flatoperands(a), key=hash), sorted(flatoperands(b), key=hash)
+                if [hash(c) for c in lhs] != [hash(c) for c in rhs]:
+                    return False
+            else:
+                if type(a) != type(b) or a.content != b.content:
+                    return False
+                lhs, rhs = a.children(), b.children()
+            stack.extend(zip(lhs, rhs))
+        return True
+
+    def __str__(self):
+        " Writes the tree as a string, pieces are emitted with an explicit stack so deep trees don't recurse "
+        out = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, Expression):
+                stack.extend(reversed(item._strparts()))
+            else:
+                out.append(str(item))
+        return ''.join(out)
+
+    def diff(self, var='x'):
+        " Differentiates by var, computing the derivative of every distinct subtree once and remembering it in diffcache "
+        derivs = {}
+        def cached(node):
+            derivative = diffcache.getnode(node, var)
+            if derivative is not None:
+                derivs[id(node)] = derivative
+                return True
+            return False
+        if cached(self):
+            return derivs[id(self)]
+        polys = polynomials(self)               # polynomial subtrees are differentiated as Polynomials, giving compact results
+        def polynomial(node):
+            if id(node) in polys:
+                derivs[id(node)] = polys[id(node)].diff(var).to_expression()
+                diffcache.putnode(node, derivs[id(node)], var)
+                return True
+            return False
+        if polynomial(self):
+            return derivs[id(self)]
+        for node in postorder(self, skip=lambda c: id(c) in derivs or cached(c) or polynomial(c)):
+            d = [derivs[id(c)] if isinstance(c, Expression) else Constant(0) for c in node.children()]
+            derivs[id(node)] = node._diff(var, *d)
+            diffcache.putnode(node, derivs[id(node)], var)
+        return derivs[id(self)]
+
+    def gradient(self, vars=None):
+        " Returns the list of derivatives by each variable (default: all, sorted) "
+        if vars is None:
+            vars = self.variables()
+        return [self.diff(var) for var in vars]
+
+    def hessian(self, vars=None):
+        " Returns the matrix (list of rows) of second derivatives, the mixed ones are computed once "
+        if vars is None:
+            vars = self.variables()
+        gradient = self.gradient(vars)
+        rows = [[None] * len(vars) for var in vars]
+        for i in range(len(vars)):
+            for j in range(i, len(vars)):
+                rows[i][j] = rows[j][i] = gradient[i].diff(vars[j])
+        return rows
+
+    def bounds(self, box):
+        " Returns (low, high) containing every value of the tree for variables in box (variable -> (low, high) or a number) "
+        missing = [var for var in self.variables() if var not in box]
+        if missing:
+            raise ValueError('No values given for: %s' % ', '.join(missing))
+        nodes, arguments = tape(self)
+        intervals = [None] * len(nodes)
+        for i, node in enumerate(nodes):
+            if type(node) == Variable:
+                value = box[node.content]
+                lo, hi = (value, value) if isinstance(value, (int, float)) else value
+                if not lo <= hi:
+                    raise ValueError('Empty interval for %s: %r' % (node.content, value))
+                intervals[i] = (float(lo), float(hi))
+            elif type(node) == Constant:
+                intervals[i] = (float(node.content), float(node.content))
+            else:
+                intervals[i] = node._bounds(*[intervals[j] for j in arguments[i]])
+        return intervals[-1]
+
+    def derivative_at(self, d, direction):
+        " Forward mode: returns the value and the derivative in direction (a variable, or a dict of variable -> component) at d "
+        if not isinstance(direction, dict):
+            direction = {direction: 1}
+        missing = [var for var in self.variables() if var not in d]
+        if missing:
+            raise ValueError('No values given for: %s' % ', '.join(missing))
+        nodes, arguments = tape(self)
+        values = tapevalues(nodes, arguments, d)
+        dots = [0] * len(nodes)                 # each node is a dual number: its value plus dot times epsilon
+        for i, node in enumerate(nodes):
+            if type(node) == Variable:
+                dots[i] = direction.get(node.content, 0)
+            elif any([dots[j] for j in arguments[i]]):     # a node whose children have no dot has none either
+                args = [values[j] for j in arguments[i]]
+                partials = node._partials(values[i], *args)
+                dots[i] = sum([p * dots[j] for p, j in zip(partials, arguments[i]) if dots[j]])   # children without dot can't contribute
+        return values[-1], dots[-1]
+
+    def gradient_at(self, d, vars=None):
+        " Reverse mode: returns the value and the list of derivatives by each variable (default: all, sorted) at d "
+        if vars is None:
+            vars = self.variables()
+        missing = [var for var in self.variables() if var not in d]
+        if missing:
+            raise ValueError('No values given for: %s' % ', '.join(missing))
+        nodes, arguments = tape(self)
+        values = tapevalues(nodes, arguments, d)
+        adjoints = [0] * len(nodes)             # derivative of the root by each node, pushed from parents to children
+        adjoints[-1] = 1
+        for i in range(len(nodes) - 1, -1, -1):
+            if adjoints[i] == 0 or not arguments[i]:
+                continue
+            partials = nodes[i]._partials(values[i], *[values[j] for j in arguments[i]])
+            for p, j in zip(partials, arguments[i]):
+                adjoints[j] += adjoints[i] * p
+        gradient = dict((node.content, adjoints[i]) for i, node in enumerate(nodes) if type(node) == Variable)
+        return values[-1], [gradient.get(var, 0) for var in vars]
+
+    def __reduce__(self):           # pickled as one flat buffer (no recursion), loading interns the nodes again
+        return (decode, (self.encode().tobytes(),))
+
+    def children(self):
+        " Returns the child nodes of this node "
+        if self.operands is not None:
+            return self.operands
+        if self.rhs is not None:
+            return (self.lhs, self.rhs)
+        if self.lhs is not None:
+            return (self.lhs,)
+        return ()
+
+    def withChildren(self, *children):
+        " Returns a node of the same type with the given children "
+        if len(children) == len(self.children()) and all(a is b for a, b in zip(children, self.children())):
+            return self
+        return type(self)(*children)
     
     # overloading operators and functions
     def __add__(self, other):
@@ -134,247 +900,931 @@ class Expression():
         return LogNode(self)
     
     
-    def visualizeTree(self): 
-        " Uses turtle module to visualize the expression tree "
-        def tele_to(x, y):        # Teleports to coordinates (without drawing)
-            t.penup()
-            t.goto(x, y)
-            t.pendown()
-        def draw(self, x, y, dx): # Draws lines to connect nodes and writes down text for operators/variables/constants etc.
-            if self != None:
-                t.goto(x, y)
-                tele_to(x, y-20)
-                # Writes down type of node in corresponding colour and font
-                if self.content in oplist:      # operator = black
-                    t.pencolor('Black')
-                    t.write(self.content, move = False, align='left', font=('Arial', 14, 'bold'))
-                elif self.content in flist:     # function = green
-                    t.pencolor('Green')
-                    t.write(self.content, move = False, align='left', font=('Arial', 12, 'bold'))
-                elif type(self) == Variable:    # variable = red
-                    t.pencolor('Red')
-                    t.write(self.content, move = False, align='left', font=('Arial', 12, 'normal'))
-                elif type(self) == Constant:    # constant = blue
-                    t.pencolor('Blue')
-                    t.write(self.content, move = False, align='left', font=('Arial', int(13 - (len(str(self.content))/2)), 'normal'))
-                t.pencolor('Black')             # switches back to the colour black
-                draw(self.lhs, x-dx, y-60, dx/2)# draws steeper lines after every recursion in order to make it fit
-                tele_to(x, y-20)
-                draw(self.rhs, x+dx, y-60, dx/2)
-        def depth(self):                        # calculates maximum depth in order to determine appropriate measurements
-            if self != None:
-                depth_lrs = depth(self.lhs)
-                depth_rhs = depth(self.rhs)
-                
-                if (depth_lrs > depth_rhs):
-                    return depth_lrs + 1
-                else:
-                    return depth_rhs + 1
-            else:
-                return 0        
+    def visualizeTree(self, limit=1000):
+        " Uses turtle module to visualize the expression tree; beyond limit nodes, subtrees are drawn collapsed "
+        import turtle                           # imported here, as tkinter is slow to load and not always installed
+        items = treelayout(self, limit)
+        width = max(item[2] for item in items) + 1
+        height = max(item[3] for item in items) + 1
+        screen = turtle.Screen()
+        screen.setworldcoordinates(-40, -60 * height, 40 * width, 30)   # 40 units per leaf, 60 per level
+        screen.tracer(0)                        # no animation, the whole drawing is shown at once by update()
         t = turtle.Turtle()
-        h = depth(self)                 # height
-        if h>= 10:
-            return print("Expression tree is too large to visualize. You might want to try .simplify() first")
-        tele_to(0, 30*h)                # starting location
-        draw(self, 0, 30*h, 30*h)       # draws whole tree
-        t.hideturtle()                  # hides turtle
+        t.hideturtle()
+        t.penup()
+        for label, kind, x, y, parent in items:     # lines to connect nodes
+            if parent is not None:
+                t.goto(40 * items[parent][2], -60 * items[parent][3] - 25)
+                t.pendown()
+                t.goto(40 * x, -60 * y)
+                t.penup()
+        for label, kind, x, y, parent in items:     # text for operators/variables/constants etc. in the colour of their kind
+            t.goto(40 * x, -60 * y - 20)
+            t.pencolor(treecolours[kind])
+            t.write(label, move=False, align='center', font=('Arial', 12, 'bold' if kind in ('operator', 'function') else 'normal'))
+        screen.update()
         turtle.mainloop()               # closes interactive mode
 
+
+    def to_dot(self, limit=1000):
+        " Returns the tree in the Graphviz DOT language; beyond limit nodes, subtrees are collapsed "
+        lines = ['digraph expression {', '    node [shape=plaintext];']
+        for i, (label, kind, x, y, parent) in enumerate(treelayout(self, limit)):
+            lines.append('    n%d [label="%s", fontcolor="%s"];' % (i, label.replace('\\', '\\\\').replace('"', '\\"'), treecolours[kind].lower()))
+            if parent is not None:
+                lines.append('    n%d -> n%d;' % (parent, i))
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+
+    def to_svg(self, limit=1000):
+        " Returns a drawing of the tree as an SVG document; beyond limit nodes, subtrees are collapsed "
+        items = treelayout(self, limit)
+        width = 40 * (max(item[2] for item in items) + 1)
+        height = 60 * (max(item[3] for item in items) + 1)
+        lines = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" font-family="Arial" font-size="12" text-anchor="middle">' % (width, height)]
+        for label, kind, x, y, parent in items:
+            if parent is not None:
+                lines.append('<line x1="%g" y1="%g" x2="%g" y2="%g" stroke="black"/>'
+                             % (40 * items[parent][2] + 20, 60 * items[parent][3] + 25, 40 * x + 20, 60 * y + 10))
+        for label, kind, x, y, parent in items:
+            label = label.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            lines.append('<text x="%g" y="%d" fill="%s">%s</text>' % (40 * x + 20, 60 * y + 20, treecolours[kind].lower(), label))
+        lines.append('</svg>')
+        return '\n'.join(lines) + '\n'
+
         
-    def simplify(self, prev = None):
-        " Simplifies Expression Tree "
+    def simplify(self):
+        " Simplifies Expression Tree: rewrite rules and canonical form, then polynomial parts are written out if that is shorter "
+        result = self._canonicalform()
+        if result._expanded is None:            # polynomials are expanded once, not again after the rules changed them
+            expanded = expandpolynomials(result)
+            if expanded is not result:
+                expanded = expanded._canonicalform()
+                object.__setattr__(result, '_expanded', expanded)
+            object.__setattr__(expanded, '_expanded', fixpoint)
+        return result if result._expanded is fixpoint else result._expanded
+
+    def _canonicalform(self):
+        " Applies the rewrite rules bottom-up, then the canonical form, until neither changes anything "
+        result = self._rewritten()
+        while True:
+            flat = result.flatten()
+            if flat is result:
+                return result
+            rewritten = flat._rewritten()
+            if rewritten is flat:
+                return flat
+            result = rewritten
+
+
+    def _rewritten(self):
+        " Applies the rewrite rules in a single bottom-up pass, every node is rewritten at most once "
+        if self._simplified is not None:
+            return self if self._simplified is fixpoint else self._simplified
+        if instrumentation.enabled:
+            instrumentation.count('rewrite passes')
+        for node in postorder(self, skip=lambda c: c._simplified is not None):    # marker: this (shared) subtree was already simplified
+            children = [(c if c._simplified is fixpoint else c._simplified) if isinstance(c, Expression) else constant(c) for c in node.children()]
+            result = node.withChildren(*children)
+            while True:                         # children are simplified, so only the rules for this node are left
+                rewritten = result._rewrite()
+                if rewritten is result:
+                    break
+                result = rewritten
+            object.__setattr__(result, '_simplified', fixpoint)
+            if node is not result:
+                object.__setattr__(node, '_simplified', result)
+        return self if self._simplified is fixpoint else self._simplified
+
+
+    def flatten(self):
+        " Returns the canonical form: chains of +, - and * become SumNode/ProductNode with sorted operands and like terms collected "
+        if self._canonical is not None:
+            return self if self._canonical is fixpoint else self._canonical
+        if instrumentation.enabled:
+            instrumentation.count('flatten passes')
+        def canon(node):
+            return node if node._canonical is None or node._canonical is fixpoint else node._canonical
+        def chain(node):                        # the kind of chain a node is part of
+            if family(node) == '+' or type(node) == SubNode or type(node) == NegNode:
+                return '+'
+            return family(node)
+        nodes = list(postorder(self, skip=lambda c: c._canonical is not None))
+        needed = {id(self)}                     # chain roots and other nodes; the inside of a chain is collected by its root
+        for node in nodes:
+            for c in node.children():
+                if chain(c) is None or chain(c) != chain(node):
+                    needed.add(id(c))
+        for node in nodes:
+            if id(node) not in needed:
+                continue
+            if chain(node) == '+':
+                result = collectsum(node, canon)
+            elif chain(node) == '*':
+                result = collectproduct(node, canon)
+            else:
+                result = node.withChildren(*[canon(c) if isinstance(c, Expression) else constant(c) for c in node.children()])
+            object.__setattr__(result, '_canonical', fixpoint)
+            if node is not result:
+                object.__setattr__(node, '_canonical', result)
+        return self if self._canonical is fixpoint else self._canonical
+
+
+    def _rewrite(self):
+        " Applies the simplification rules to this node only, assuming its children are simplified "
         if type(self) == Constant or type(self) == Variable:
             return self
-        try: 
+        values = [constvalue(c) for c in self.children()]
+        if None not in values:
             # Simplying parts with just Constants
-            c = float(eval(str(self)))
-            if c >= 0:                          # when evaluation of children is larger than zero -> just use constant
-                if float(c) == int(c):          
-                    self = Constant(int(c))
-                    return self
-                else:
-                    self = Constant(float(c))
-                    return self
-            elif c < 0:                         # when evaluation of children is less than zero -> use negation
-                if float(c) == int(c):
-                    self = NegNode(int(abs(c)))
-                    return self
+            try:
+                if isinstance(self, (BinaryNode, NaryNode)):
+                    c = functools.reduce(operators[self.content], values)
+                elif isinstance(self, Function):
+                    c = mathfuncs[self.content](values[0])
                 else:
-                    self = NegNode(float(abs(c)))
-                    return self
-        except:
-            # individual special cases for each operator/function with present variables
-            if type(self) == MulNode:
-                if self.rhs.content == 0 or self.lhs.content == 0:
-                    self = Constant(0)
-                    return self
-                elif self.rhs.content == 1:
-                    self = self.lhs
-                elif self.lhs.content == 1:
-                    self = self.rhs      
-            elif type(self) == DivNode:
-                if self.rhs.content == 0:
-                    print("ERROR! Division by zero is not valid! Cannot be simplified.")    # exception 1) for division by zero which is not allowed
-                elif self.rhs.content == 1:
-                    self = self.lhs
-                elif self.lhs.content == 0:
-                    self = Constant(0)
-                    return self
-            elif type(self) == AddNode:
-                if self.rhs.content == 0:
-                    self = self.lhs
-                elif self.lhs.content == 0:
-                    self = self.rhs 
-            elif type(self) == SubNode:
-                if self.rhs.content == 0:
-                    self = self.lhs
-                elif self.lhs.content == 0 and self.rhs.content != 0:
-                    self = NegNode(self.lhs) 
-                    return self
-            elif type(self) == PowNode:
-                if self.rhs.content == 0:
-                    self = Constant(1)
-                    return self
-                elif self.rhs.content == 1:
-                    self = self.lhs    
-            elif type(self) == LogNode:
-                if self.lhs.content == 0:
-                    print("ERROR! Log(0) is not valid! Cannot be simplified.")              # exception 2) for log(0) which is also not allowed
-                if self.lhs.content == 1:
-                    self = Constant(0)
-                    return self 
-            elif type(self) == CosNode or type(self) == ExpNode:               # same case for both cos (x) and e^x
-                if self.lhs.content == 0:
-                    self = Constant(1)
-                    return self
-            elif type(self) == SinNode:
-                if self.lhs.content == 0:
-                    self = Constant(0)
-                    return self 
-        if type(self) != Constant and type(self) != Variable:        
-            self.lhs = Expression.simplify(self.lhs)
-            if not isinstance(self, Function) and not isinstance(self, NegNode):
-                self.rhs = Expression.simplify(self.rhs)
-        if self == prev:                                                       # if nothing changes after another recursion, simplify stops
-            return self
-        else: 
-            return self.simplify(prev = self)
+                    c = -values[0]
+                return constant(c)
+            except (ArithmeticError, ValueError, TypeError):
+                pass                            # not a real number (division by zero, log(0), ...), handled below
+        # individual special cases for each operator/function with present variables
+        if type(self) == MulNode:
+            if self.rhs.content == 0 or self.lhs.content == 0:
+                return Constant(0)
+            elif self.rhs.content == 1:
+                return self.lhs
+            elif self.lhs.content == 1:
+                return self.rhs      
+        elif type(self) == DivNode:
+            if self.rhs.content == 0:
+                warnings.warn("Division by zero is not valid! Cannot be simplified.", RuntimeWarning)   # exception 1) for division by zero which is not allowed
+            elif self.rhs.content == 1:
+                return self.lhs
+            elif self.lhs.content == 0:
+                return Constant(0)
+        elif type(self) == AddNode:
+            if self.rhs.content == 0:
+                return self.lhs
+            elif self.lhs.content == 0:
+                return self.rhs 
+        elif type(self) == SubNode:
+            if self.rhs.content == 0:
+                return self.lhs
+            elif self.lhs.content == 0:
+                return NegNode(self.rhs) 
+        elif type(self) == PowNode:
+            if self.rhs.content == 0:
+                return Constant(1)
+            elif self.rhs.content == 1:
+                return self.lhs    
+        elif type(self) == LogNode:
+            if self.lhs.content == 0:
+                warnings.warn("Log(0) is not valid! Cannot be simplified.", RuntimeWarning)             # exception 2) for log(0) which is also not allowed
+            if self.lhs.content == 1:
+                return Constant(0)
+        elif type(self) == CosNode or type(self) == ExpNode:               # same case for both cos (x) and e^x
+            if self.lhs.content == 0:
+                return Constant(1)
+        elif type(self) == SinNode:
+            if self.lhs.content == 0:
+                return Constant(0)
+        return self
 
 
-    def findVariable(self, var, val):       # to be called for partial evaluations
-        try:    
-            if type(self) == Variable and str(self.content) == var:
-                return Constant(val)
-            self.lhs = self.lhs.findVariable(var, val)
-            if not isinstance(self, Function) and not isinstance(self, NegNode):
-                self.rhs = self.rhs.findVariable(var, val)
-            return self
-        except AttributeError:
+    def cse(self):
+        " Common subexpression elimination: returns the tree as a SharedExpression of temporaries and a result "
+        parents = {}                            # id(node) -> number of distinct parents referring to it
+        order = list(postorder(self))           # distinct nodes, children before parents
+        for node in order:
+            for c in node.children():
+                parents[id(c)] = parents.get(id(c), 0) + 1
+        prefix = 't'
+        while any(var.startswith(prefix) for var in self.variables()):
+            prefix = '_' + prefix
+        temps, replaced = [], {}
+        for node in order:
+            new = node.withChildren(*[replaced.get(id(c), c) for c in node.children()])
+            if node is not self and parents.get(id(node), 0) > 1 and node.children() and constvalue(node) is None:
+                name = '%s%d' % (prefix, len(temps))
+                temps.append((name, new))
+                new = Variable(name)
+            replaced[id(node)] = new
+        return SharedExpression(temps, replaced[id(self)])
+
+
+    def to_sympy(self):
+        " Converts the tree to a sympy expression (sympy is only imported when this is used) "
+        import sympy
+        values = {}
+        for node in postorder(self):
+            args = [values[id(c)] if isinstance(c, Expression) else sympy.sympify(c) for c in node.children()]
+            if type(node) == Constant:
+                values[id(node)] = sympy.sympify(node.content)
+            elif type(node) == Variable:
+                values[id(node)] = sympy.Symbol(node.content)
+            elif isinstance(node, (BinaryNode, NaryNode)):
+                values[id(node)] = functools.reduce(operators[node.content], args)
+            elif isinstance(node, Function):
+                values[id(node)] = getattr(sympy, node.content)(args[0])
+            else:
+                values[id(node)] = -args[0]
+        return values[id(self)]
+
+
+    def from_sympy(expr):
+        " Makes Expression Tree from a sympy expression built from +, *, **, numbers, symbols and the functions in flist "
+        import sympy
+        trees = {}
+        stack = [expr]
+        while stack:                            # post-order walk over the sympy tree without recursion
+            e = stack[-1]
+            if e in trees:
+                stack.pop()
+                continue
+            pending = [a for a in e.args if a not in trees]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            args = [trees[a] for a in e.args]
+            if isinstance(e, sympy.Symbol):
+                trees[e] = Variable(e.name)
+            elif isinstance(e, sympy.Integer):
+                trees[e] = constant(int(e))
+            elif isinstance(e, sympy.Rational):
+                trees[e] = constant(int(e.p)) / Constant(int(e.q))
+            elif e.is_number and e.is_real:     # floats and constants such as pi and E
+                trees[e] = constant(float(e))
+            elif isinstance(e, sympy.Add):
+                trees[e] = functools.reduce(operator.add, args)
+            elif isinstance(e, sympy.Mul):
+                trees[e] = functools.reduce(operator.mul, args)
+            elif isinstance(e, sympy.Pow):
+                trees[e] = args[0] ** args[1]
+            elif isinstance(e, sympy.Function) and type(e).__name__ in flist:
+                trees[e] = getattr(Expression, type(e).__name__)(args[0])
+            else:
+                raise ValueError('Cannot convert %s to an Expression' % e)
+        return trees[expr]
+
+
+    def encode(self):
+        " Returns the tree as a FlatTree: postfix opcode/operand arrays, shared subtrees are stored once "
+        flat = FlatTree()
+        positions, floats, ints, names = {}, {}, {}, {}
+        stack = [(self, False)]
+        while stack:                            # postfix walk, a node that was already written becomes a reference
+            node, expanded = stack.pop()
+            if isinstance(node, Expression) and id(node) in positions and not expanded:
+                flat.opcodes.append(REF)
+                flat.operands.append(positions[id(node)])
+                continue
+            children = node.children() if isinstance(node, Expression) else ()
+            if children and not expanded:
+                stack.append((node, True))
+                stack.extend((c, False) for c in reversed(children))
+                continue
+            value = node.content if isinstance(node, Expression) else node
+            if type(node) == Variable:
+                flat.opcodes.append(flatcodes[Variable])
+                operand = names.setdefault(value, len(names))
+            elif children:
+                flat.opcodes.append(flatcodes[type(node)])
+                operand = len(children)
+            elif isinstance(value, int) and -2**63 <= value < 2**63:
+                flat.opcodes.append(INT)
+                operand = ints.setdefault(value, len(ints))
+            elif isinstance(value, int):        # too big for the ints array, kept in hexadecimal with the names
+                flat.opcodes.append(BIGINT)
+                operand = names.setdefault(hex(value), len(names))
+            else:
+                flat.opcodes.append(FLOAT)
+                operand = floats.setdefault(value, len(floats))
+            flat.operands.append(operand)
+            if isinstance(node, Expression):
+                positions[id(node)] = len(flat.opcodes) - 1
+        flat.floats.extend(floats)
+        flat.ints.extend(ints)
+        flat.names = list(names)
+        return flat
+
+
+    def findVariable(self, var, val):       # to be called for partial evaluations, returns a new tree
+        replaced = {}
+        for node in postorder(self):
+            if type(node) == Variable and str(node.content) == var:
+                replaced[id(node)] = Constant(val)
+            else:
+                replaced[id(node)] = node.withChildren(*[replaced.get(id(c), c) for c in node.children()])
+        return replaced[id(self)]
+
+
+    def substitute(self, bindings):
+        " Returns the tree with the given variables replaced by constants, folding constants in the same pass; cached in specializecache "
+        bound = frozenset([(var, bindings[var]) for var in self.variables() if var in bindings])
+        if not bound:
             return self
+        specialized = specializecache.getnode(self, bound)
+        if specialized is not None:
+            return specialized
+        values = dict(bound)
+        replaced = {}
+        for node in postorder(self):
+            if type(node) == Variable and node.content in values:
+                result = constant(values[node.content])
+            else:
+                result = node.withChildren(*[replaced.get(id(c), c) for c in node.children()])
+                while result is not node:       # only nodes with a substituted child are rewritten
+                    rewritten = result._rewrite()
+                    if rewritten is result:
+                        break
+                    result = rewritten
+            replaced[id(node)] = result
+        specializecache.putnode(self, replaced[id(self)], bound)
+        return replaced[id(self)]
+
+
+    def variables(self):
+        " Returns the sorted names of all variables in the tree "
+        if self._variables is None:             # trees are immutable, so the walk is done once
+            object.__setattr__(self, '_variables', sorted(set(str(node.content) for node in postorder(self) if type(node) == Variable)))
+        return list(self._variables)
+
+
+    def compile(self, vars=None, backend='math'):
+        " Turns the tree into a Python function of the given variables (default: all, sorted), cached on the tree "
+        if vars is None:
+            vars = self.variables()
+        key = (tuple(vars), backend)
+        cache = self._compiled
+        if cache is None:
+            cache = {}
+            object.__setattr__(self, '_compiled', cache)   # caches are the only state set after construction
+        if key not in cache:
+            if backend == 'math':
+                namespace = dict(mathfuncs)
+            elif backend == 'numpy':            # numpy is only needed (and imported) for batch evaluation
+                import numpy
+                namespace = {f: getattr(numpy, f) for f in flist}
+            else:
+                raise ValueError('Unknown backend: %s' % backend)
+            source = codegen(self, key[0], namespace)
+            exec(source, namespace)
+            if instrumentation.enabled:
+                instrumentation.count('functions compiled')
+            cache[key] = namespace['_compiled']
+        return cache[key]
+
+
+    def evaluate_batch(self, d, chunksize=65536):
+        " Evaluates the tree for arrays of variable values with NumPy, chunksize samples at a time to bound memory "
+        import numpy
+        vars = self.variables()
+        missing = [var for var in vars if var not in d]
+        if missing:
+            raise ValueError('No values given for: %s' % ', '.join(missing))
+        f = self.compile(vars, backend='numpy')
+        arrays = numpy.broadcast_arrays(*[numpy.asarray(d[var], dtype=float) for var in vars])
+        shape = arrays[0].shape if arrays else ()
+        size = int(numpy.prod(shape))
+        flat = [a.ravel() if a.flags.c_contiguous else None for a in arrays]    # broadcast views are not, ravel() would copy them whole
+        out = numpy.empty(size)
+        for start in range(0, max(size, 1), chunksize):
+            stop = min(start + chunksize, size)
+            index = numpy.unravel_index(numpy.arange(start, stop), shape) if any(a is None for a in flat) else None
+            args = [a[start:stop] if a is not None else b[index] for a, b in zip(flat, arrays)]     # only chunk sized copies
+            out[start:stop] = f(*args)          # constants broadcast over the chunk
+        return out.reshape(shape)
         
         
-    def evaluate(self, d={}):                   # uses dictionary to fill in value for the given variables
-        try:                                    # simple evaluate with all values of variables given
-            for var in d:
-                exec("%s = %d" % (var, d[var])) 
-            return eval(str(self))
-        except:                                 # partial evaluation
-            for var in d:
-                self = self.findVariable(var, d[var])     
-            return self.simplify()    
+    def evaluate_many(self, bindings, workers=None, chunksize=1024):
+        " Evaluates the tree for every dict in bindings on a pool of worker processes, returning the results in order "
+        from concurrent.futures import ProcessPoolExecutor     # multiprocessing is slow to import, only load it when used
+        vars = self.variables()
+        constants = {}
+        source = codegen(self, vars, constants)        # the generated source is sent once to every worker
+        rows = ([d[var] for var in vars] for d in bindings)
+        chunks = iter(lambda: list(itertools.islice(rows, chunksize)), [])
+        workers = workers or os.cpu_count() or 1
+        results, pending = [], deque()
+        with ProcessPoolExecutor(workers, initializer=startworker, initargs=(source, constants)) as pool:
+            for chunk in chunks:                # bindings are read lazily, with a bounded number of chunks in flight
+                pending.append(pool.submit(evaluatechunk, chunk))
+                if len(pending) >= 2 * workers:
+                    results.extend(pending.popleft().result())
+            while pending:
+                results.extend(pending.popleft().result())
+        return results
+
+
+    def to_source(self, name, vars=None, backend='python'):
+        " Returns the source of a module defining function name(vars) that computes the tree with math or numpy, without the tree "
+        if vars is None:
+            vars = self.variables()
+        modules = {'python': 'math', 'numpy': 'numpy'}
+        if backend not in modules:
+            raise ValueError('Unknown backend: %s' % backend)
+        for var in [name] + list(vars):
+            if not var.isidentifier() or keyword.iskeyword(var) or var == modules[backend]:
+                raise ValueError('Not usable as a Python name: %s' % var)
+        source = codegen(self, vars, None, name, list(vars), modules[backend] + '.')
+        return 'import %s\n\n\n%s' % (modules[backend], source)
+
+
+    def to_module(self, directory, name='f', vars=None, backend='python'):
+        " Returns function name of to_source(), written to a module in directory under the SHA-256 of the tree and imported from there "
+        import hashlib
+        import importlib.util
+        if vars is None:
+            vars = self.variables()
+        key = hashlib.sha256(self.encode().tobytes())
+        key.update(repr((name, list(vars), backend)).encode())
+        module = 'expr_' + key.hexdigest()
+        path = os.path.join(directory, module + '.py')
+        if not os.path.exists(path):            # written once; afterwards the import also finds the cached bytecode
+            os.makedirs(directory, exist_ok=True)
+            temporary = '%s.%d.tmp' % (path, os.getpid())
+            with open(temporary, 'w') as f:
+                f.write(self.to_source(name, vars, backend))
+            os.replace(temporary, path)         # other processes never see a half written module
+        spec = importlib.util.spec_from_file_location(module, path)
+        loaded = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(loaded)
+        return getattr(loaded, name)
+
+
+    def evaluator(self, d):
+        " Returns an Evaluator of the tree for the values in d, to evaluate it again after some of them change "
+        return Evaluator(self, d)
+
+
+    def evaluate(self, d=None):                 # uses dictionary to fill in value for the given variables
+        if d is None:
+            d = {}
+        vars = self.variables()
+        if all(var in d for var in vars):       # simple evaluate with all values of variables given
+            return self.compile(vars)(*[d[var] for var in vars])
+        return self.substitute(d)               # partial evaluation
                 
     
     def fromString(string):
-        " Makes Expression Tree from string input "
-        #step 1: Puts string in RPN with Shunting-Yard algoritm
-        
-        tokens = tokenize(string)                           # turn string into list with operator values 
-        stack, output = [], []                              # creates stack list Shunting Yard and output list for RPN
-        for token, value in tokens:
-            if token == 'num':
-                if isint(value):                            # append the numbers to the output as a float or an int
-                    output.append(Constant(int(value))) 
+        " Makes Expression Tree from string input; trees are immutable, so parses of the same string are shared through parsecache "
+        tree = parsecache.get(string)
+        if tree is None:
+            tree = Expression.parse(string)
+            parsecache.put(string, tree)
+        return tree
+
+
+    def parse(string):
+        " Makes Expression Tree from string input, with the Shunting-Yard algorithm building nodes directly "
+        operands, stack = [], []                # operand stack of subtrees, operator stack of (kind, value, position)
+        def apply(kind, value, pos):            # replaces the operands of an operator by the new node
+            if kind == 'oper':
+                rhs = operands.pop()
+                operands[-1] = operators[value](operands[-1], rhs)
+            elif kind == 'neg':
+                operands[-1] = -operands[-1]
+            else:
+                operands[-1] = getattr(Expression, value)(operands[-1])
+        expect = True                           # True when an operand (or prefix) has to come next
+        afterfunc = False
+        pos = 0
+        for token, value, pos in lex(string):
+            if afterfunc and token != 'leftp':
+                raise ParseError('Expected ( after function', pos)
+            afterfunc = False
+            if token == 'num' or token == 'var':
+                if not expect:
+                    raise ParseError('Unexpected %s' % value, pos)
+                if token == 'var':
+                    operands.append(Variable(value))
+                elif value.isdigit():           # append the numbers as a float or an int
+                    operands.append(Constant(int(value)))
                 else:
-                    output.append(Constant(float(value)))
-            elif token == 'func':
-                stack.append((token,value))                 # will be evaluated by Shunting Yard
-            elif token == 'var':
-                output.append(Variable(value))              # append variables to output list              
-            elif token == 'oper' or token == 'neg':
-                value1 = value
-                if stack:
-                    while stack[-1][0] == 'oper' or stack[-1][0] == 'neg':   # While there are operators left to process
-                        value2 = stack[-1][1]                                # Copy values from the top of the stack
-                        if ((associativity[value1] == 'Left' and (precedence[value1] <= precedence[value2]))
-                        or (associativity[value1] == 'Right' and (precedence[value1] < precedence[value2]))):
-                            # Evaluate precedence and associativity of operators
-                            output.append(stack.pop())
-                            if not stack:
-                                break
-                        else:
-                            break        
-                stack.append((token,value))         
-            elif token == 'leftp':                      # when token is LEFT paranthesis
-                stack.append((token,value))             # token is added to top of stack
-                
-            elif token == 'rightp':                     # when token is RIGHT paranthesis
-                while stack[-1][0] != 'leftp':          # as long there are no left parantheses on top of stack
-                    try:                                # add all items on stack to output
-                        output.append(stack.pop())
-                    except IndexError:                  # catches error for incorrect use of parantheses
-                        raise 'MismatchedParenthesis'
+                    operands.append(Constant(float(value)))
+                expect = False
+            elif token == 'func' or token == 'leftp' or token == 'neg':
+                if not expect:
+                    raise ParseError('Unexpected %s' % value, pos)
+                stack.append((token, value, pos))
+                afterfunc = token == 'func'
+            elif token == 'oper':
+                if expect:
+                    raise ParseError('Missing operand before %s' % value, pos)
+                if value not in oplist or value == '%':
+                    raise ParseError('Unsupported operator %s' % value, pos)
+                while stack and (stack[-1][0] == 'oper' or stack[-1][0] == 'neg'):   # While there are operators left to process
+                    top = stack[-1][1]
+                    if ((associativity[value] == 'Left' and precedence[value] <= precedence[top])
+                    or (associativity[value] == 'Right' and precedence[value] < precedence[top])):
+                        apply(*stack.pop())
+                    else:
+                        break
+                stack.append((token, value, pos))
+                expect = True
+            elif token == 'rightp':
+                if expect:
+                    raise ParseError('Missing operand before )', pos)
+                while stack and stack[-1][0] != 'leftp':
+                    apply(*stack.pop())
+                if not stack:
+                    raise ParseError('Mismatched parenthesis', pos)
                 stack.pop()
-                if len(stack) > 0 and stack[-1][0] == 'func': # when left paranthesis is found and function is on top of stack
-                    output.append(stack.pop())                # add it to output
-            else: 
-                raise ValueError('Unknown token: %s' % token) # catches error for incorrect use of tokens
-                    
-        while stack:                                    # after all tokens are evaluated, elements still on stack are added to output
-            token = stack.pop()
-            if token == 'leftp' or token == 'rightp':
-                raise 'MismatchedParenthesis'
-            output.append(token)
-            
-        # step 2: convert RPN to actual expression tree
-        for t in output:
-            if type(t) == tuple:                                # reduce to just its value
-                t = t[1]
-            try:       
-                if t in oplist:
-                    y = stack.pop()
-                    x = stack.pop()
-                    stack.append(eval('x %s y' % t))            # evaluate operators
-                elif t in flist:
-                    x = stack.pop()
-                    stack.append(eval('Expression.%s(x)' % t))  # evaluate functions
-                elif t == '#':
-                    x = stack.pop()
-                    stack.append(eval('-x'))                    # evaluate negations
-                else:
-                    stack.append(t)
-            except TypeError:
-                 stack.append(t) 
-        return stack[0]                                         # return Expression Tree 
+                if stack and stack[-1][0] == 'func':    # when left paranthesis is found and function is on top of stack
+                    apply(*stack.pop())
+        if afterfunc:
+            raise ParseError('Expected ( after function', len(string))
+        if expect:
+            raise ParseError('Unexpected end of expression', len(string))
+        while stack:                            # after all tokens are read, operators still on stack are applied
+            token, value, pos = stack.pop()
+            if token == 'leftp':
+                raise ParseError('Mismatched parenthesis', pos)
+            apply(token, value, pos)
+        return operands[0]                      # return Expression Tree 
       
     
+parsecache = LRUCache(1024)             # string -> tree cache in front of Expression.fromString
+diffcache = LRUCache(65536)             # (id(node), variable) -> (node, derivative) cache used by Expression.diff
+tapecache = LRUCache(1024)              # (id(node), None) -> (node, tape) cache used by the forward and reverse mode derivatives
+specializecache = LRUCache(1024)        # (id(node), bound variables) -> (node, specialized tree) cache used by Expression.substitute
+
+
+class SharedExpression():
+    """An expression written as a sequence of named temporaries followed by a result using them"""
+    def __init__(self, temps, result):
+        self.temps = temps                      # list of (name, Expression), each may use the names before it
+        self.result = result
+
+    def __str__(self):
+        lines = ['%s = %s' % (name, temp) for name, temp in self.temps]
+        lines.append(str(self.result))
+        return '\n'.join(lines)
+
+    def evaluate(self, d=None):
+        " Evaluates the temporaries in order and then the result, all variables must be given "
+        values = dict(d or {})
+        for name, temp in self.temps:
+            values[name] = temp.evaluate(values)
+        return self.result.evaluate(values)
+
+
+class Polynomial():
+    """A polynomial as a sparse dict from monomials to nonzero coefficients, a monomial being a tuple of (variable, power)
+    pairs sorted by variable; () is the constant term. Coefficients are ints, Fractions (from division by an int) or floats"""
+    maxterms = 1000                             # from_expression gives up on polynomials with more terms than this
+
+    def __init__(self, terms=None):
+        self.terms = dict((m, c.numerator if type(c) == Fraction and c.denominator == 1 else c)
+                          for m, c in (terms or {}).items() if c != 0)
+        self._scheme = None
+
+    def __eq__(self, other):
+        return isinstance(other, Polynomial) and self.terms == other.terms
+
+    def __str__(self):
+        return str(self.to_expression())
+
+    def __add__(self, other):
+        terms = dict(self.terms)
+        for m, c in other.terms.items():
+            terms[m] = terms.get(m, 0) + c
+        return Polynomial(terms)
+
+    def __neg__(self):
+        return Polynomial(dict((m, -c) for m, c in self.terms.items()))
+
+    def __sub__(self, other):
+        return self + -other
+
+    def __mul__(self, other):
+        terms = {}
+        for m1, c1 in self.terms.items():
+            for m2, c2 in other.terms.items():
+                powers = dict(m1)
+                for var, p in m2:
+                    powers[var] = powers.get(var, 0) + p
+                m = tuple(sorted(powers.items()))
+                terms[m] = terms.get(m, 0) + c1 * c2
+        return Polynomial(terms)
+
+    def __pow__(self, n):
+        " Raises to a non-negative integer power by repeated squaring "
+        result, square = Polynomial({(): 1}), self
+        while n:
+            if n & 1:
+                result = result * square
+            n >>= 1
+            if n:
+                square = square * square
+        return result
+
+    def variables(self):
+        return sorted(set(var for m in self.terms for var, p in m))
+
+    def diff(self, var='x'):
+        terms = {}
+        for m, c in self.terms.items():
+            for i, (v, p) in enumerate(m):
+                if v == var:
+                    rest = m[:i] + ((v, p - 1),) + m[i+1:] if p > 1 else m[:i] + m[i+1:]
+                    terms[rest] = terms.get(rest, 0) + c * p
+        return Polynomial(terms)
+
+    def evaluate(self, d):
+        " Evaluates with the Horner scheme in each variable in turn, all variables must be given "
+        if self._scheme is None:                # the nesting of the Horner scheme is built once
+            self._scheme = hornerscheme(self.terms, self.variables())
+        return hornerevaluate(self._scheme, d)
+
+    def from_expression(tree, maxterms=None, nodes=None, budget=None):
+        " Makes a Polynomial of a tree of +, -, *, negation, division by constants and constant natural powers, else None "
+        maxterms = maxterms or Polynomial.maxterms
+        budget = budget or [float('inf')]       # number of term operations left, shared between calls by polynomials()
+        def multiply(a, b):                     # None when the product could take too long
+            if a is None or b is None or len(a.terms) * len(b.terms) > min(64 * maxterms, budget[0]):
+                return None
+            budget[0] -= len(a.terms) * len(b.terms)
+            return a * b
+        def chain(node):                        # the kind of chain a node is part of, as in flatten()
+            if family(node) == '+' or type(node) == SubNode or type(node) == NegNode:
+                return '+'
+            return family(node)
+        def value(c):
+            if isinstance(c, Expression):
+                return polys[id(c)]
+            return Polynomial({(): c})
+        nodes = nodes or list(postorder(tree))
+        needed = {id(tree)}                     # chain roots and other nodes; the inside of a chain is collected by its root
+        for node in nodes:
+            for c in node.children():
+                if chain(c) is None or chain(c) != chain(node):
+                    needed.add(id(c))
+        polys = {}
+        for node in nodes:
+            if id(node) not in needed:
+                continue
+            if type(node) == Constant:
+                result = Polynomial({(): node.content})
+            elif type(node) == Variable:
+                result = Polynomial({((node.content, 1),): 1})
+            elif chain(node) == '+':            # all signed terms of the chain are added into one dict
+                terms = {}
+                stack = [(node, 1)]
+                while stack:
+                    n, sign = stack.pop()
+                    if n is not node and id(n) in needed:
+                        budget[0] -= len(value(n).terms)
+                        for m, c in value(n).terms.items():
+                            terms[m] = terms.get(m, 0) + sign * c
+                    elif type(n) == SubNode:
+                        stack.extend([(n.lhs, sign), (n.rhs, -sign)])
+                    elif type(n) == NegNode:
+                        stack.append((n.lhs, -sign))
+                    else:
+                        stack.extend((c, sign) for c in n.children())
+                result = Polynomial(terms)
+            elif chain(node) == '*':
+                result = functools.reduce(multiply, [value(c) for c in flatoperands(node)])
+            elif type(node) == DivNode and constvalue(node.rhs) is not None and constvalue(node.rhs) != 0:
+                c = constvalue(node.rhs)
+                result = value(node.lhs) * Polynomial({(): Fraction(1, c) if isinstance(c, int) else 1 / c})  # x/3 stays exact
+            elif type(node) == PowNode and isnatural(constvalue(node.rhs)):
+                result, square, n = Polynomial({(): 1}), value(node.lhs), int(constvalue(node.rhs))
+                while n and result is not None:         # repeated squaring
+                    if n & 1:
+                        result = multiply(result, square)
+                    n >>= 1
+                    if n:
+                        square = multiply(square, square)
+            else:
+                return None
+            if result is None or len(result.terms) > maxterms or budget[0] < 0:
+                return None
+            polys[id(node)] = result
+        return polys[id(tree)]
+
+    def to_expression(self):
+        " Makes the canonical Expression Tree, ordered as simplify() orders sums and products "
+        terms, const = [], 0
+        for m, c in self.terms.items():
+            if not m:
+                const = c
+                continue
+            factors = [Variable(var) if p == 1 else PowNode(Variable(var), Constant(p)) for var, p in m]
+            rest = factors[0] if len(factors) == 1 else ProductNode(*factors)
+            terms.append((sortkey(rest), c, rest))
+        result = [rational(c, rest) for key, c, rest in sorted(terms, key=lambda t: t[0])]
+        if const != 0 or not result:
+            result.append(rational(const))      # the constant term goes last
+        return result[0] if len(result) == 1 else SumNode(*result)
+
+
+# group the terms of a polynomial by the power of the first variable, recursively: (variable, [(power, scheme), ...]) with
+# the powers from high to low, or the coefficient when no variables are left
+def hornerscheme(terms, vars):
+    if not vars:
+        c = sum(terms.values())
+        return float(c) if type(c) == Fraction else c      # evaluated like the tree, x/3 gives a float
+    groups = {}
+    for m, c in terms.items():
+        p = m[0][1] if m and m[0][0] == vars[0] else 0
+        rest = m[1:] if p else m
+        groups.setdefault(p, {})[rest] = c
+    return (vars[0], [(p, hornerscheme(groups[p], vars[1:])) for p in sorted(groups, reverse=True)])
+
+# evaluate a Horner scheme: ((a x^(p-q) + b) x^(q-r) + c) x^r
+def hornerevaluate(scheme, d):
+    if not isinstance(scheme, tuple):
+        return scheme
+    var, groups = scheme
+    x = d[var]
+    result, previous = 0, groups[0][0]
+    for p, inner in groups:
+        result = result * x ** (previous - p) + hornerevaluate(inner, d)
+        previous = p
+    return result * x ** previous
+
+# True for a whole number that is not negative
+def isnatural(e):
+    return isinstance(e, (int, float)) and isfinite(e) and e >= 0 and e == int(e)
+
+# the maximal subtrees of tree that are polynomials with variables (and not too large), as id(node) -> Polynomial
+def polynomials(tree):
+    nodes = list(postorder(tree))
+    ispoly, hasvars = {}, {}                    # structural test and whether there are variables, bottom-up
+    for node in nodes:
+        t = type(node)
+        if t == Constant or t == Variable:
+            ispoly[id(node)], hasvars[id(node)] = True, t == Variable
+            continue
+        children = [c for c in node.children() if isinstance(c, Expression)]
+        hasvars[id(node)] = any([hasvars[id(c)] for c in children])
+        if t in polynomialtypes:
+            ispoly[id(node)] = all([ispoly[id(c)] for c in children])
+        elif t == DivNode:
+            ispoly[id(node)] = ispoly.get(id(node.lhs), True) and constvalue(node.rhs) is not None and constvalue(node.rhs) != 0
+        elif t == PowNode:
+            ispoly[id(node)] = ispoly.get(id(node.lhs), True) and isnatural(constvalue(node.rhs))
+        else:
+            ispoly[id(node)] = False
+    result, candidates = {}, {id(tree)}
+    budget = [4 * len(nodes) + Polynomial.maxterms]   # the work spent on polynomials stays linear in the size of the tree
+    for node in reversed(nodes):                # parents before children
+        if id(node) not in candidates:
+            continue
+        if ispoly[id(node)] and hasvars[id(node)] and type(node) != Variable and budget[0] > 0:
+            p = Polynomial.from_expression(node, nodes=nodes if node is tree else None, budget=budget)
+            if p is not None:
+                result[id(node)] = p
+                continue
+        candidates.update(id(c) for c in node.children())    # not a polynomial (or too large): try its children
+    return result
+
+# the number of nodes of every subtree as it is printed, id(node) -> size; a shared subtree counts every time it is used
+def treesizes(tree, skip=None):
+    sizes = {}
+    for node in postorder(tree, skip):
+        sizes[id(node)] = 1 + sum([sizes.get(id(c), 1) if isinstance(c, Expression) else 1 for c in node.children()])
+    return sizes
+
+# tree with its polynomial subtrees written out where that takes fewer nodes, e.g. (x + 1) * (x - 1) becomes x ** 2 - 1
+def expandpolynomials(tree):
+    polys = polynomials(tree)
+    if not polys:
+        return tree
+    sizes = treesizes(tree)
+    replaced = {}
+    def rebuilt(node):
+        if id(node) in polys and id(node) not in replaced:     # polynomials are not walked into, they are replaced whole
+            expanded = polys[id(node)].to_expression()
+            replaced[id(node)] = expanded if treesizes(expanded)[id(expanded)] < sizes[id(node)] else node
+        return replaced.get(id(node), node)
+    if id(tree) in polys:
+        return rebuilt(tree)
+    for node in postorder(tree, skip=lambda c: id(c) in polys):
+        replaced[id(node)] = node.withChildren(*[rebuilt(c) if isinstance(c, Expression) else c for c in node.children()])
+    return replaced[id(tree)]
+
+class AsyncTrees():
+    """Awaitable versions of the heavy tree operations, run in an executor (default: the loop's thread pool); trees can be
+    pickled, so a ProcessPoolExecutor works too"""
+    def __init__(self, executor=None):
+        self.executor = executor
+
+    async def run(self, function, *args):
+        " Runs function(*args) in the executor and returns its result "
+        import asyncio                          # only imported by asyncio users, it is slow to load
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def fromString(self, string):
+        return await self.run(Expression.fromString, string)
+
+    async def diff(self, tree, var='x'):
+        return await self.run(tree.diff, var)
+
+    async def simplify(self, tree):
+        return await self.run(tree.simplify)
+
+    async def substitute(self, tree, bindings):
+        return await self.run(tree.substitute, bindings)
+
+    async def evaluate(self, tree, d=None):
+        return await self.run(tree.evaluate, d)
+
+
+class Evaluator():
+    """Evaluates a tree and remembers the value of every subtree, so that a change of some variables only recomputes the
+    nodes on the paths from those variables to the root"""
+    def __init__(self, tree, d):
+        self.tree = tree
+        self.nodes = list(postorder(tree))      # distinct nodes, children before parents; the root is last
+        position = {id(node): i for i, node in enumerate(self.nodes)}
+        self.values = [None] * len(self.nodes)
+        self.functions = []                     # per node: the function computing its value from its arguments
+        self.arguments = []                     # per node: positions in values of its children
+        self.parents = [[] for node in self.nodes]
+        self.variables = {}                     # variable -> position of its node
+        self.bindings = {}
+        for i, node in enumerate(self.nodes):
+            args = []
+            for c in node.children():
+                if isinstance(c, Expression):
+                    args.append(position[id(c)])
+                    self.parents[args[-1]].append(i)
+                else:                           # a plain number as child gets a slot of its own
+                    args.append(len(self.values))
+                    self.values.append(c)
+            if type(node) == Variable:
+                self.variables[node.content] = i
+                f = functools.partial(self.bindings.__getitem__, node.content)
+            elif type(node) == Constant:
+                f = functools.partial(operator.pos, node.content)
+            elif isinstance(node, NaryNode):
+                f = functools.partial(lambda op, *args: functools.reduce(op, args), operators[node.content])
+            elif isinstance(node, BinaryNode):
+                f = operators[node.content]
+            elif isinstance(node, Function):
+                f = mathfuncs[node.content]
+            else:
+                f = operator.neg
+            self.functions.append(f)
+            self.arguments.append(args)
+        self.paths = LRUCache(256)              # variable -> positions of the nodes depending on it, in order
+        missing = [var for var in self.variables if var not in d]
+        if missing:
+            raise ValueError('No values given for: %s' % ', '.join(sorted(missing)))
+        self.bindings.update(d)
+        self._recompute(range(len(self.nodes)))
+
+    def dependents(self, var):
+        " Returns the positions of the nodes whose value depends on var, children before parents "
+        path = self.paths.get(var)
+        if path is None:
+            found = set()
+            stack = [self.variables[var]] if var in self.variables else []
+            while stack:                        # walk up to every ancestor of the variable
+                i = stack.pop()
+                if i not in found:
+                    found.add(i)
+                    stack.extend(self.parents[i])
+            path = sorted(found)
+            self.paths.put(var, path)
+        return path
+
+    def _recompute(self, positions):
+        values, functions, arguments = self.values, self.functions, self.arguments
+        for i in positions:
+            values[i] = functions[i](*[values[j] for j in arguments[i]])
+
+    def update(self, d):
+        " Changes the values of the given variables and returns the new value of the tree "
+        changed = [var for var in d if var in self.variables and self.bindings[var] != d[var]]
+        self.bindings.update(d)
+        if len(changed) == 1:
+            self._recompute(self.dependents(changed[0]))
+        elif changed:
+            self._recompute(sorted(set().union(*[self.dependents(var) for var in changed])))
+        return self.value
+
+    @property
+    def value(self):
+        return self.values[len(self.nodes) - 1]
+
+
 class Variable(Expression):
     """Represents variable"""
+    __slots__ = ()
+
     def __init__(self, x):
-        self.content = Symbol(str(x))
-        self.lhs = None
-        self.rhs = None
-     
-    def __eq__(self, other):
-        if isinstance(other, Variable):
-            return self.content == other.content
-        else:
-            return False
-        
-    def __str__(self):
-        return str(self.content)
+        self._init(None, None, str(x), hash(('Variable', str(x))))
+
+    def _strparts(self):
+        return [self.content]
 
-    def diff(self,var='x'):
+    def _diff(self, var):
         if str(self.content) == var:
             return Constant(1)
         else:
@@ -383,19 +1833,13 @@ class Variable(Expression):
 
 class Constant(Expression):
     """Represents a constant value"""
+    __slots__ = ()
+
     def __init__(self, value):
-        self.content = value
-        self.lhs = None
-        self.rhs = None
-        
-    def __eq__(self, other):
-        if isinstance(other, Constant):
-            return self.content == other.content
-        else:
-            return False
-        
-    def __str__(self):
-        return str(self.content)
+        self._init(None, None, value, hash(('Constant', value)))
+
+    def _strparts(self):
+        return [self.content]
         
     # allow conversion to numerical values
     def __int__(self):
@@ -404,172 +1848,521 @@ class Constant(Expression):
     def __float__(self):
         return float(self.content)
 
-    def diff(self,var='x'):
+    def _diff(self, var):
         return Constant(0)
         
 class BinaryNode(Expression):
     """A node in the expression tree representing a binary operator."""
+    __slots__ = ()
     
     def __init__(self, lhs, rhs, op_symbol):
-        self.lhs = lhs
-        self.rhs = rhs
-        self.content = op_symbol
+        self._init(lhs, rhs, op_symbol, hash((type(self).__name__, hash(lhs), hash(rhs))))
     
-    def __eq__(self, other):
-        if type(self) == type(other):
-            if self.content == '+' or self.content == '*':
-                return (self.lhs == other.lhs and self.rhs == other.rhs) or (self.lhs == other.rhs and self.rhs == other.lhs)
-            else:
-                return self.lhs == other.lhs and self.rhs == other.rhs
-        else:
-            return False
-            
-    def __str__(self):              # overloading of __str__ which calls its children (other subclasses) in the process 
-        lstring = str(self.lhs)
-        rstring = str(self.rhs)
-        if isinstance(self.lhs, BinaryNode) and precedence[self.lhs.content] <= precedence[self.content]:
-            lstring = '(' + lstring + ')'
-        if isinstance(self.rhs, BinaryNode) and precedence[self.rhs.content] <= precedence[self.content]:        
-            rstring = '(' + rstring + ')'
-        return "%s %s %s" % (lstring, self.content, rstring)
+    def _strparts(self):            # pieces of the string, children are written in their place by __str__
+        lparts = [self.lhs]
+        rparts = [self.rhs]
+        if isinstance(self.lhs, (BinaryNode, NaryNode)) and precedence[self.lhs.content] <= precedence[self.content]:
+            lparts = ['(', self.lhs, ')']
+        if isinstance(self.rhs, (BinaryNode, NaryNode)) and precedence[self.rhs.content] <= precedence[self.content]:        
+            rparts = ['(', self.rhs, ')']
+        return lparts + [' %s ' % self.content] + rparts
+
+    def _apply(self, a, b):         # value of the node from the values of its children
+        return operators[self.content](a, b)
 
 class UnaryNode(Expression):
     """A node in the expression tree representing a unary operator."""
+    __slots__ = ()
 
     def __init__(self,lhs,op_symbol):
-        self.lhs = lhs
-        self.rhs = None
-        self.content = op_symbol
+        self._init(lhs, None, op_symbol, hash((type(self).__name__, hash(lhs))))
 
-    def __eq__(self, other):
-        if type(self) == type(other):
-            return self.lhs == other.lhs
-        else:
-            return False
-    def __str__(self):
-        lstring = str(self.lhs)
-        return "%s %s" % (self.content,lstring)
+    def _strparts(self):
+        if isinstance(self.lhs, (BinaryNode, NaryNode)):   # negation binds stronger than any operator when parsed
+            return [self.content, ' (', self.lhs, ')']
+        return [self.content, ' ', self.lhs]
+
+    def _apply(self, a):
+        return -a
     
 class Function(Expression):
     """A node in the expressin tree representing a function operator."""
+    __slots__ = ()
+
     def __init__(self,lhs,content):
-        self.lhs = lhs
-        self.content = content
-        self.rhs = None
+        self._init(lhs, None, content, hash((type(self).__name__, hash(lhs))))
 
-    def __str__(self):
-        lstring = str(self.lhs)
-        return "%s(%s)" % (self.content, lstring)
+    def _strparts(self):
+        return [self.content, '(', self.lhs, ')']
+
+    def _apply(self, a):
+        return mathfuncs[self.content](a)
     
+class NaryNode(Expression):
+    """A node in the expression tree applying an associative and commutative operator to any number of operands."""
+    __slots__ = ()
+
+    def __init__(self, operands, op_symbol):
+        self._init(None, None, op_symbol, None, tuple(operands))
+
+    def _strparts(self):
+        parts = []
+        for i, c in enumerate(self.operands):
+            if i > 0 and self.content == '+' and type(c) == NegNode:
+                parts.append(' - ')             # a + - b is written as a - b
+                c = c.lhs
+            elif i > 0:
+                parts.append(' %s ' % self.content)
+            if isinstance(c, (BinaryNode, NaryNode)) and precedence[c.content] <= precedence[self.content]:
+                parts.extend(['(', c, ')'])
+            else:
+                parts.append(c)
+        return parts
+
+    def _apply(self, *args):
+        return functools.reduce(operators[self.content], args)
+
+class SumNode(NaryNode):
+    """Represents a sum of any number of terms, in canonical order as built by flatten()"""
+    __slots__ = ()
+
+    def __init__(self, *terms):
+        super(SumNode, self).__init__(terms, '+')
+
+    def _diff(self, var, *dterms):
+        result = functools.reduce(operator.add, dterms)
+        return result
+
+    def _partials(self, value, *args):  # derivative of the value by each child, used by forward and reverse mode
+        return (1,) * len(args)
+
+    def _bounds(self, *args):           # interval of the value from the intervals of the children
+        return functools.reduce(addbounds, args)   # every addition can round, so each one is widened
+
+class ProductNode(NaryNode):
+    """Represents a product of any number of factors, in canonical order as built by flatten()"""
+    __slots__ = ()
+
+    def __init__(self, *factors):
+        super(ProductNode, self).__init__(factors, '*')
+
+    def _diff(self, var, *dfactors):
+        terms = []
+        for i, d in enumerate(dfactors):        # product rule: differentiate one factor at a time
+            terms.append(functools.reduce(operator.mul, self.operands[:i] + (d,) + self.operands[i+1:]))
+        result = functools.reduce(operator.add, terms)
+        return result
+
+    def _partials(self, value, *args):
+        before, after = [1] * len(args), [1] * len(args)
+        for i in range(1, len(args)):          # products of the factors before and after each one, so zeros are fine
+            before[i] = before[i-1] * args[i-1]
+            after[-i-1] = after[-i] * args[-i]
+        return tuple(b * a for b, a in zip(before, after))
+
+    def _bounds(self, *args):
+        return functools.reduce(mulbounds, args)
+
 class AddNode(BinaryNode):
     """Represents the addition operator"""
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super(AddNode, self).__init__(lhs, rhs, '+')
 
-    def diff(self,var='x'):
-        result = self.lhs.diff(var) + self.rhs.diff(var)
+    def _diff(self, var, dlhs, drhs):
+        result = dlhs + drhs
         return result
+
+    def _partials(self, value, a, b):
+        return (1, 1)
+
+    def _bounds(self, a, b):
+        return addbounds(a, b)
         
 class SubNode(BinaryNode):
     """Represents the subtraction operator"""
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super(SubNode, self).__init__(lhs, rhs, '-')
         
-    def diff(self,var='x'):
-        result = self.lhs.diff(var) - self.rhs.diff(var)
+    def _diff(self, var, dlhs, drhs):
+        result = dlhs - drhs
         return result
+
+    def _partials(self, value, a, b):
+        return (1, -1)
+
+    def _bounds(self, a, b):
+        return outward(a[0] - b[1], a[1] - b[0])
     
 class MulNode(BinaryNode):
     """Represents the multiplication operator"""
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super(MulNode, self).__init__(lhs, rhs, '*')
 
-    def diff(self,var='x'):
-        result = (self.lhs.diff(var)*self.rhs)+(self.rhs.diff(var)*self.lhs)
+    def _diff(self, var, dlhs, drhs):
+        result = (dlhs*self.rhs)+(drhs*self.lhs)
         return result        
+
+    def _partials(self, value, a, b):
+        return (b, a)
+
+    def _bounds(self, a, b):
+        return mulbounds(a, b)
         
 class DivNode(BinaryNode):
     """Represents the division operator"""
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super(DivNode, self).__init__(lhs, rhs, '/')
 
-    def diff(self,var='x'):
-        result = (self.lhs.diff(var)*self.rhs-self.rhs.diff(var)*self.lhs)/(self.rhs**2)
+    def _diff(self, var, dlhs, drhs):
+        result = (dlhs*self.rhs-drhs*self.lhs)/(self.rhs**Constant(2))
         return result
+
+    def _partials(self, value, a, b):
+        return (1 / b, -value / b)
+
+    def _bounds(self, a, b):
+        if b[0] <= 0 <= b[1]:
+            raise DomainError('Division by zero is not valid! The divisor %s can be 0 for values in [%r, %r]' % (self.rhs, b[0], b[1]))
+        return mulbounds(a, outward(1 / b[1], 1 / b[0]))
         
 class PowNode(BinaryNode):
     """Represents the exponential operator"""
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super(PowNode, self).__init__(lhs, rhs, '**') 
 
-    def diff(self,var='x'):
+    def _diff(self, var, dlhs, drhs):
         f = self.lhs
         g = self.rhs
-        df = self.lhs.diff(var)
-        dg = self.rhs.diff(var)
+        df = dlhs
+        dg = drhs
         result = f**(g-Constant(1))*(g*df+f*Expression.log(f)*dg)
         return result           
+
+    def _partials(self, value, a, b):
+        if a == 0 and b < 1:                    # a**(b-1) would divide by zero: the slope at 0 is infinite, or 0 for a**0
+            da = 0 if b == 0 else float('inf')
+        else:
+            da = b * a**(b-1)
+        if a > 0:
+            return (da, value * log(a))
+        return (da, 0 if a == 0 else float('nan'))  # by the exponent: only defined for a positive base
+
+    def _bounds(self, a, b):
+        n = integervalue(self.rhs)
+        if n is None and b[0] == b[1] and b[0] == int(b[0]):
+            n = int(b[0])
+        if n is not None:                       # an integer exponent allows any base
+            if n == 0:
+                return (1.0, 1.0)
+            if n < 0:
+                if a[0] <= 0 <= a[1]:
+                    raise DomainError('Division by zero is not valid! %s can be 0 for values in [%r, %r]' % (self.lhs, a[0], a[1]))
+                lo, hi = PowNode(self.lhs, Constant(-n))._bounds(a, (float(-n), float(-n)))
+                return outward(1 / hi if hi else inf, 1 / lo if lo else inf)
+            ends = [power(a[0], n), power(a[1], n)]
+            if n % 2 == 1:                      # odd powers are increasing
+                return outward(*ends)
+            if a[0] < 0 < a[1]:                 # even powers have their minimum at 0
+                return outward(0.0, max(ends))
+            return outward(min(ends), max(ends))
+        if a[0] < 0 or (a[0] == 0 and b[0] <= 0):
+            raise DomainError('Power is not valid! The base %s can be 0 or negative for values in [%r, %r]' % (self.lhs, a[0], a[1]))
+        ends = [power(x, y) for x in a for y in b]     # monotonic in base and exponent for a positive base
+        return outward(min(ends), max(ends))
     
 class XorNode(BinaryNode):
     """Represents the exclusive or operator"""
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super(XorNode, self).__init__(lhs, rhs, '^')
 
-    def diff(self,var='x'):
+    def _diff(self, var, dlhs, drhs):
         print("You cannot diff Xor. Did you mean **?")
 
+    def _partials(self, value, a, b):
+        raise ValueError("You cannot diff Xor. Did you mean **?")
+
+    def _bounds(self, a, b):
+        raise DomainError("No bounds for Xor. Did you mean **?")
+
 class SinNode(Function):
     """Represents the sin function"""
+    __slots__ = ()
+
     def __init__(self, lhs):
         super (SinNode, self).__init__(lhs,'sin')
 
-    def diff(self,var='x'):
-        result = self.lhs.diff(var)*Expression.cos(self.lhs)
+    def _diff(self, var, dlhs):
+        result = dlhs*Expression.cos(self.lhs)
         return result
 
+    def _partials(self, value, a):
+        return (cos(a),)
+
+    def _bounds(self, a):
+        return periodicbounds(sin, pi / 2, a[0], a[1])
+
 class TanNode(Function):
     """Represents the tan function"""
+    __slots__ = ()
+
     def __init__(self,lhs):
         super (TanNode,self).__init__(lhs,'tan')
 
-    def diff(self,var='x'):
-        result = (Constant(2)*self.lhs.diff(var))/(Expression.cos(Constant(2)*self.lhs)+Constant(1))
+    def _diff(self, var, dlhs):
+        result = (Constant(2)*dlhs)/(Expression.cos(Constant(2)*self.lhs)+Constant(1))
         return result
 
+    def _partials(self, value, a):
+        return (1 + value * value,)
+
+    def _bounds(self, a):
+        if pi / 2 + pi * ceil((a[0] - pi / 2) / pi) <= a[1]:
+            raise DomainError('Tan is not valid at pi/2 + k*pi, which %s can reach for values in [%r, %r]' % (self.lhs, a[0], a[1]))
+        return outward(tan(a[0]), tan(a[1]))
+
 class CosNode(Function):
     """Represents the cos function"""
+    __slots__ = ()
+
     def __init__(self,lhs):
         super (CosNode,self).__init__(lhs,'cos')
 
-    def diff(self,var='x'):
-        result = self.lhs.diff(var)*-Expression.sin(self.lhs)
+    def _diff(self, var, dlhs):
+        result = dlhs*-Expression.sin(self.lhs)
         return result
 
+    def _partials(self, value, a):
+        return (-sin(a),)
+
+    def _bounds(self, a):
+        return periodicbounds(cos, 0.0, a[0], a[1])
+
 class LogNode(Function):
     """Represents the natural logarithm"""
+    __slots__ = ()
+
     def __init__(self,lhs):
         super (LogNode,self).__init__(lhs,'log')
 
-    def diff(self,var='x'):
-        result = self.lhs.diff(var) / self.lhs
+    def _diff(self, var, dlhs):
+        result = dlhs / self.lhs
         return result
 
+    def _partials(self, value, a):
+        return (1 / a,)
+
+    def _bounds(self, a):
+        if a[0] <= 0:
+            raise DomainError('Log is not valid! %s can be 0 or negative for values in [%r, %r]' % (self.lhs, a[0], a[1]))
+        return outward(log(a[0]), log(a[1]))
+
 class ExpNode(Function):
     """Represents the exponent (e^x)"""
+    __slots__ = ()
+
     def __init__(self,lhs):
         super (ExpNode,self).__init__(lhs,'exp')
 
-    def diff(self,var='x'):
-        result = self.lhs.diff(var)*Expression.exp(self.lhs)
+    def _diff(self, var, dlhs):
+        result = dlhs*Expression.exp(self.lhs)
         return result
+
+    def _partials(self, value, a):
+        return (value,)
+
+    def _bounds(self, a):
+        return outward(exponential(a[0]), exponential(a[1]))
     
 class NegNode(UnaryNode):
     """Represents the negative operator (-)"""
+    __slots__ = ()
+
     def __init__(self,lhs):
         super (NegNode,self).__init__(lhs,'-')
  
-    def diff(self,var='x'):
-        return -self.lhs.diff(var)
+    def _diff(self, var, dlhs):
+        return -dlhs
+
+    def _partials(self, value, a):
+        return (-1,)
+
+    def _bounds(self, a):
+        return (-a[1], -a[0])
+
+class FlatTree():
+    """A tree in postfix order in flat arrays: an opcode and an operand per node, with tables of constants and names"""
+    header = struct.Struct('<4sB3xIIII')    # magic, byte order, number of nodes, floats, ints, bytes of names
+
+    def __init__(self):
+        self.opcodes = array('B')               # node type, see flatclasses; REF repeats the node at position operand
+        self.operands = array('i')              # index in floats/ints/names (also BIGINT), number of children or referenced position
+        self.floats = array('d')
+        self.ints = array('q')
+        self.names = []
+
+    def tobytes(self):
+        " Returns the arrays as one contiguous buffer (native byte order), e.g. to put in shared memory "
+        names = '\0'.join(self.names).encode()
+        head = self.header.pack(b'EXPR', sys.byteorder == 'little', len(self.opcodes), len(self.floats), len(self.ints), len(names))
+        return b''.join([head, self.floats.tobytes(), self.ints.tobytes(), self.operands.tobytes(), self.opcodes.tobytes(), names])
+
+    def frombytes(buffer):
+        " Makes a FlatTree whose arrays are views on buffer (bytes, mmap, shared memory), without copying them "
+        view = memoryview(buffer).cast('B')
+        magic, little, n, nfloats, nints, nnames = FlatTree.header.unpack_from(view)
+        if magic != b'EXPR':
+            raise ValueError('Not an encoded expression tree')
+        if little != (sys.byteorder == 'little'):
+            raise ValueError('Encoded expression tree has the wrong byte order')
+        flat = FlatTree()
+        start = FlatTree.header.size        # the 8 byte arrays come first, so every array stays aligned
+        for field, code, count in (('floats', 'd', nfloats), ('ints', 'q', nints), ('operands', 'i', n), ('opcodes', 'B', n)):
+            end = start + count * array(code).itemsize
+            setattr(flat, field, view[start:end].cast(code))
+            start = end
+        flat.names = bytes(view[start:start + nnames]).decode().split('\0') if nnames else []
+        return flat
+
+    def decode(self):
+        " Rebuilds the Expression tree "
+        nodes, stack = [], []
+        for op, operand in zip(self.opcodes, self.operands):
+            if op == REF:
+                node = nodes[operand]
+            elif op == INT:
+                node = Constant(self.ints[operand])
+            elif op == FLOAT:
+                node = Constant(self.floats[operand])
+            elif op == BIGINT:
+                node = Constant(int(self.names[operand], 16))
+            elif flatclasses[op] == Variable:
+                node = Variable(self.names[operand])
+            else:
+                children = stack[len(stack) - operand:]
+                del stack[len(stack) - operand:]
+                node = flatclasses[op](*children)
+            nodes.append(node)
+            stack.append(node)
+        return stack[0]
+
+    def evaluate(self, d=None):
+        " Evaluates directly on the arrays with a stack machine, all variables must be given "
+        d = d or {}
+        values, stack = [], []
+        for op, operand in zip(self.opcodes, self.operands):
+            if op == REF:
+                value = values[operand]
+            elif op == INT:
+                value = self.ints[operand]
+            elif op == FLOAT:
+                value = self.floats[operand]
+            elif op == BIGINT:
+                value = int(self.names[operand], 16)
+            elif flatclasses[op] == Variable:
+                value = d[self.names[operand]]  # a variable is written once, later uses are REFs
+            else:
+                args = stack[len(stack) - operand:]
+                del stack[len(stack) - operand:]
+                symbol = flatsymbols[op]
+                if symbol in mathfuncs:
+                    value = mathfuncs[symbol](args[0])
+                elif flatclasses[op] == NegNode:
+                    value = -args[0]
+                else:
+                    value = functools.reduce(operators[symbol], args)
+            values.append(value)
+            stack.append(value)
+        return stack[0]
+
+
+def decode(buffer):
+    " Makes Expression Tree from a buffer written by FlatTree.tobytes() "
+    return FlatTree.frombytes(buffer).decode()
+
+
+class TreeStore():
+    """A dict of named trees kept in a directory, one file per tree in the FlatTree binary form; a tree is read (through
+    mmap, without parsing or differentiating anything) when it is first used"""
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._trees = {}                        # name -> tree used in this session
+
+    def _path(self, name):
+        if not name or name.startswith('.') or os.sep in name or (os.altsep and os.altsep in name):
+            raise KeyError(name)
+        return os.path.join(self.directory, name + '.tree')
+
+    def __contains__(self, name):
+        return name in self._trees or os.path.exists(self._path(name))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return sorted(f[:-len('.tree')] for f in os.listdir(self.directory) if f.endswith('.tree'))
+
+    def flat(self, name):
+        " Returns the stored FlatTree, its arrays are views on the mapped file (e.g. for FlatTree.evaluate without decoding) "
+        try:
+            with open(self._path(name), 'rb') as f:
+                return FlatTree.frombytes(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            raise KeyError(name)
+
+    def __getitem__(self, name):
+        if name not in self._trees:
+            self._trees[name] = self.flat(name).decode()
+        return self._trees[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __setitem__(self, name, tree):
+        path = self._path(name)
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as f:
+            f.write(tree.encode().tobytes())
+        os.replace(temporary, path)             # a reader never sees a half written tree
+        self._trees[name] = tree
+
+    def __delitem__(self, name):
+        self._trees.pop(name, None)
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            raise KeyError(name)
+
+
+# opcodes of FlatTree; the order is part of the binary format, so new node types are only appended
+flatclasses = [None, Constant, Constant, Variable, AddNode, SubNode, MulNode, DivNode, PowNode, XorNode,
+               SinNode, CosNode, TanNode, LogNode, ExpNode, NegNode, SumNode, ProductNode, Constant]
+REF, INT, FLOAT, BIGINT = 0, 1, 2, 18
+flatsymbols = [None, None, None, None, '+', '-', '*', '/', '**', '^',
+               'sin', 'cos', 'tan', 'log', 'exp', '-', '+', '*', None]
+flatcodes = {cls: code for code, cls in enumerate(flatclasses) if code > FLOAT and cls != Constant}
+
+# node types that are polynomials when all their children are, see polynomials()
+polynomialtypes = (AddNode, SubNode, MulNode, SumNode, ProductNode, NegNode)
+
 
 if __name__ == '__main__':
     "testcase"
@@ -0,0 +1,257 @@
+" Benchmarks for the expression tree operations on machine-generated expressions "
+from Expressiebomen import *
+import argparse
+import gc
+import json
+import operator
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def timed(name, n, f):
+    " Runs f once and prints its time and throughput in terms per second "
+    start = time.perf_counter()
+    result = f()
+    elapsed = time.perf_counter() - start
+    print('%-12s %10.3f s %14.0f terms/s' % (name, elapsed, n / elapsed if elapsed else float('inf')))
+    return result
+
+
+def longsum(n):
+    " Benchmarks every tree operation on the sum x + x + ... + x of n terms (depth n) "
+    print('sum of %d terms' % n)
+    string = '+'.join(['x'] * n)
+    tree = timed('fromString', n, lambda: Expression.fromString(string))
+    timed('str', n, lambda: str(tree))
+    x = Variable('x')
+    other = x
+    for i in range(n - 1):                  # the same sum with every + swapped, so == has to walk the whole tree
+        other = x + other
+    timed('==', n, lambda: tree == other)
+    derivative = timed('diff', n, lambda: tree.diff('x'))
+    timed('simplify', n, lambda: derivative.simplify())
+    timed('compile', n, lambda: tree.compile(['x']))
+    timed('evaluate', n, lambda: tree.evaluate({'x': 1.5}))
+    timed('evaluate 2nd', n, lambda: tree.evaluate({'x': 2.5}))     # compiled function and variables are cached
+
+
+def chain(n):
+    " A deep chain: the polynomial in x written in Horner form, nested n levels "
+    string = 'x'
+    for i in range(n):
+        string = '(%s) * x + %d' % (string, i % 7 + 1)
+    return string
+
+
+def polynomial(n):
+    " A wide polynomial: n terms c * x**i * y**j * z**k "
+    terms = []
+    for i in range(n):
+        terms.append('%d * x ** %d * y ** %d * z ** %d' % (i % 9 + 1, i % 5, i // 5 % 4, i // 20 % 3))
+    return ' + '.join(terms)
+
+
+def trig(n):
+    " Nested sin/cos/exp, n levels deep, that stays bounded for any x "
+    string = 'x'
+    for i in range(n):
+        string = '%s(%s) * x + 1' % (['sin', 'cos', 'exp'][i % 3], string)
+    return string
+
+
+def workloads(scale):
+    " The generated workloads as (name, string, number of derivatives taken) "
+    return [('chain', chain(int(1000 * scale)), 1),
+            ('polynomial', polynomial(int(1000 * scale)), 1),
+            ('trig', trig(int(300 * scale)), 1),
+            ('derivatives', 'sin(x) * exp(x) / (x ** 2 + 1)', max(1, int(6 * scale)))]
+
+
+def mirrored(tree):
+    " The same tree with the operands of every + and * swapped: equal, but a different object, so == has to walk it "
+    swapped = {}
+    for node in postorder(tree):
+        children = [swapped.get(id(c), c) for c in node.children()]
+        if type(node) == AddNode or type(node) == MulNode:
+            children.reverse()
+        swapped[id(node)] = node.withChildren(*children)
+    return swapped[id(tree)]
+
+
+def derivative(tree, order):
+    for i in range(order):
+        tree = tree.diff('x')
+    return tree
+
+
+def operations(string, order):
+    " The benchmarked operations as (name, setup, operation): setup builds the arguments, only operation is measured "
+    bindings = {'x': 0.5, 'y': 1.5, 'z': 2.5}
+    parsed = lambda: (Expression.fromString(string),)
+    return [('tokenize', lambda: (string,), tokenize),
+            ('fromString', lambda: (string,), Expression.fromString),
+            ('str', parsed, str),
+            ('==', lambda: (Expression.fromString(string), mirrored(Expression.fromString(string))), operator.eq),
+            ('diff', parsed, lambda tree: derivative(tree, order)),
+            ('simplify', lambda: (derivative(Expression.fromString(string), order),), Expression.simplify),
+            ('evaluate', parsed, lambda tree: tree.evaluate(bindings))]
+
+
+def fresh():
+    " Empties the caches, so that every run starts from nothing (nodes are dropped once nothing refers to them) "
+    for cache in (parsecache, diffcache, tapecache, specializecache):
+        cache.clear()
+    gc.collect()
+
+
+def measure(setup, operation, repeat):
+    " Returns the best time of repeat runs and the peak memory allocated by one more run under tracemalloc "
+    times = []
+    for i in range(repeat):
+        fresh()
+        args = setup()
+        gc.disable()                    # as in timeit: a collection of other garbage is not part of the operation
+        start = time.perf_counter()
+        operation(*args)
+        times.append(time.perf_counter() - start)
+        gc.enable()
+        del args
+    fresh()
+    args = setup()
+    tracemalloc.start()                 # traces only what the operation allocates; it slows it down, so it is not timed
+    operation(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def suite(scale, repeat):
+    " Runs every operation on every workload and returns {'workload/operation': {'time': s, 'peak': bytes}} "
+    results = {}
+    for name, string, order in workloads(scale):
+        for op, setup, operation in operations(string, order):
+            elapsed, peak = measure(setup, operation, repeat)
+            results['%s/%s' % (name, op)] = {'time': elapsed, 'peak': peak}
+            print('%-24s %10.4f s %10.1f KiB' % ('%s/%s' % (name, op), elapsed, peak / 1024.0))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    " Prints each result against the baseline; returns the names of the ones more than tolerance slower or bigger "
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        # a millisecond and a KiB are added to both sides, so that noise on tiny measurements isn't a regression
+        ratios = [(results[name][k] + floor) / (baseline[name][k] + floor) for k, floor in (('time', 1e-3), ('peak', 1024))]
+        regressed = any(r > 1 + tolerance for r in ratios)
+        if regressed:
+            regressions.append(name)
+        print('%-24s time x%5.2f  peak x%5.2f%s' % (name, ratios[0], ratios[1], '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def stress(threads, rounds):
+    " Runs the tree operations from many threads (and asyncio tasks) at once on the same new tree; True if all agree "
+    bindings = {'x': 0.5, 'y': 1.5, 'z': 2.5}
+    def work(string):
+        tree = Expression.fromString(string)
+        derivative = tree.diff('x')
+        return tree, [str(derivative), str(derivative.simplify()), tree.evaluate(bindings), str(tree.substitute({'y': 1.5})),
+                      tree == mirrored(tree), tree.gradient_at(bindings)[1], tree.bounds({'x': (0, 1), 'y': 1.5, 'z': 2.5})]
+    failures = 0
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)             # switch threads as often as possible, to make races likely
+    try:
+        for r in range(rounds):
+            string = '%s + %s + %d' % (trig(20), polynomial(40), r)
+            expected = work(string)[1]      # computed alone, then the tree and its caches are dropped
+            fresh()
+            results = [None] * threads
+            barrier = threading.Barrier(threads)
+            def run(i):
+                barrier.wait()
+                results[i] = work(string)
+            pool = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+            for t in pool:
+                t.start()
+            for t in pool:
+                t.join()
+            if any(result is None or result[1] != expected or result[0] is not results[0][0] for result in results):
+                failures += 1               # a different answer, or the same tree interned twice
+            del results
+            fresh()
+            import asyncio
+            async def tasks():
+                trees = AsyncTrees()
+                tree = await trees.fromString(string)
+                return await asyncio.gather(*[trees.diff(tree, 'x') for i in range(threads)])
+            derivatives = asyncio.run(tasks())
+            if any(str(d) != expected[0] for d in derivatives):
+                failures += 1
+            fresh()
+    finally:
+        sys.setswitchinterval(switch)
+    print('%d rounds of %d threads: %d failed' % (rounds, threads, failures))
+    return failures == 0
+
+
+def importtime(budget, repeat=5):
+    " Measures a fresh interpreter importing the module (best of repeat runs, minus bare startup); True if within budget "
+    def run(code):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', code])
+        return time.perf_counter() - start
+    bare = min(run('pass') for i in range(repeat))
+    full = min(run('import Expressiebomen') for i in range(repeat))
+    print('import       %10.3f s (budget %.3f s)' % (full - bare, budget))
+    return full - bare <= budget
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+    sumparser = commands.add_parser('sum', help='every operation on a long sum')
+    sumparser.add_argument('-n', type=int, default=10**6, help='number of terms in the generated sum')
+    importparser = commands.add_parser('import', help='time to import the module, fails above the budget')
+    importparser.add_argument('--budget', type=float, default=0.1, help='maximum import time in seconds')
+    suiteparser = commands.add_parser('suite', help='every operation on generated workloads, with time and peak memory')
+    suiteparser.add_argument('--scale', type=float, default=1.0, help='factor for the size of the workloads')
+    suiteparser.add_argument('--repeat', type=int, default=3, help='number of timed runs, the best one counts')
+    suiteparser.add_argument('--save', metavar='FILE', help='write the results to FILE as a baseline')
+    suiteparser.add_argument('--compare', metavar='FILE', help='compare with a saved baseline, fails on a regression')
+    suiteparser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown or growth')
+    threadparser = commands.add_parser('threads', help='stress test: many threads using the same tree, fails on a wrong result')
+    threadparser.add_argument('-t', '--threads', type=int, default=8, help='number of threads')
+    threadparser.add_argument('-r', '--rounds', type=int, default=20, help='number of rounds, each on a new tree')
+    args = parser.parse_args()
+    if args.command == 'sum':
+        sys.setrecursionlimit(1000)         # the default limit: no operation may recurse per tree level
+        longsum(args.n)
+    elif args.command == 'suite':
+        if os.environ.get('PYTHONHASHSEED') != '0':     # node hashes build on the hashes of variable names, and == sorts
+                                                        # operands by hash: its timings move with the seed, so fix it
+            os.execve(sys.executable, [sys.executable] + sys.argv, dict(os.environ, PYTHONHASHSEED='0'))
+        sys.setrecursionlimit(1000)
+        results = suite(args.scale, args.repeat)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump({'python': platform.python_version(), 'scale': args.scale, 'hashseed': os.environ['PYTHONHASHSEED'],
+                           'results': results}, f, indent=1, sort_keys=True)
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+            if baseline['scale'] != args.scale:
+                sys.exit('Baseline was made with --scale %s' % baseline['scale'])
+            if compare(results, baseline['results'], args.tolerance):
+                sys.exit(1)
+    elif args.command == 'threads':
+        if not stress(args.threads, args.rounds):
+            sys.exit(1)
+    elif not importtime(args.budget):
+        sys.exit(1)
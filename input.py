@@ -1,4 +1,10 @@
 from Expressiebomen import *
+import argparse
+import ast
+import json
+import math
+import sys
+import time
 import traceback
 trees = {}
 helpstr = {"new"        : "Create a new tree from an expression. Syntax: new <name> <expression>.",
@@ -7,84 +13,169 @@ helpstr = {"new"        : "Create a new tree from an expression. Syntax: new <na
            "print"      : "Print the expression represented by a tree. Syntax: print <name>.",
            "stop"       : "Exit the program.",
            "help"       : "You're already using this command.",
-           "visualize"  : "Visualize a tree. Syntax: visualize <name>.",
+           "visualize"  : "Visualize a tree. Syntax: visualize <name> [<file>.svg|<file>.dot].",
            "evaluate"   : "Evaluate the expression represented by a tree. Syntax: evaluate <name> <dict of vars>.\nDict of vars in the form: {'x':3,'y':7}. Variables left out result in partial evaluation.",
-           "iseq"       : "Is tree a the same as tree b? Syntax: iseq <name> <othername>."}
-print('Commands: new, simplify, diff, visualize, print, stop, evaluate, iseq, help. Other operations (+,*,etc) work too.')
-print('You must access trees outside of commands by doing: "trees['+"'treename'"+']".')
-print("For example: trees['c'] = trees['a'] + trees['b'].")
-print("Also, in order to modify a tree with a mathematical function, you must use")
-print("trees['a'] = Expression.sin(trees['a']), not sin(trees['a']).")
-print("Available functions: sin, cos, tan, log, exp")
+           "iseq"       : "Is tree a the same as tree b? Syntax: iseq <name> <othername>.",
+           "profile"    : "Show the counters and timings of the tree operations. Syntax: profile [on|off|reset]."}
 
-while True:
-    try:
-        h = input()
-        if h != "":
-            i = h.split()
-            if i[0] == "new":
-                if i[1].isalpha():
-                        trees[i[1]] = Expression.fromString("".join(i[2:]))
-                        print('New tree named "' + i[1] + '" created with expression: ' + str(trees[i[1]]))
-                else:
-                    print('Tree names must be only letters')
 
-            elif i[0] == "simplify":
-                if len(i) == 3:
-                    if i[2].isalpha():
-                        trees[i[2]] = trees[i[1]].simplify()
-                        print('Expression simplified from '+ str(trees[i[1]])+' to: ' + str(trees[i[2]]))
-                    else:
-                        print('Tree names must be only letters')                    
-                else:
-                    print('Wrong number of arguments. Expected: 2')
+def interactive():
+    " Reads commands from the keyboard and prints verbose messages "
+    print('Commands: new, simplify, diff, visualize, print, stop, evaluate, iseq, profile, help. Other operations (+,*,etc) work too.')
+    print('You must access trees outside of commands by doing: "trees['+"'treename'"+']".')
+    print("For example: trees['c'] = trees['a'] + trees['b'].")
+    print("Also, in order to modify a tree with a mathematical function, you must use")
+    print("trees['a'] = Expression.sin(trees['a']), not sin(trees['a']).")
+    print("Available functions: sin, cos, tan, log, exp")
 
-            elif i[0] == "diff":
-                if len(i) == 4:
-                    if i[3].isalpha():
-                        trees[i[3]] = trees[i[2]].diff(i[1])
-                        print('Expression differentiated from '+ str(trees[i[2]])+' to: ' + str(trees[i[3]]))
+    while True:
+        try:
+            h = input()
+            start = time.perf_counter()
+            if h != "":
+                i = h.split()
+                if i[0] == "new":
+                    if i[1].isalpha():
+                            trees[i[1]] = Expression.fromString("".join(i[2:]))
+                            print('New tree named "' + i[1] + '" created with expression: ' + str(trees[i[1]]))
                     else:
                         print('Tree names must be only letters')
-                else:
-                    print('Wrong number of arguments. Expected: 3')                
+
+                elif i[0] == "simplify":
+                    if len(i) == 3:
+                        if i[2].isalpha():
+                            trees[i[2]] = trees[i[1]].simplify()
+                            print('Expression simplified from '+ str(trees[i[1]])+' to: ' + str(trees[i[2]]))
+                        else:
+                            print('Tree names must be only letters')                    
+                    else:
+                        print('Wrong number of arguments. Expected: 2')
+
+                elif i[0] == "diff":
+                    if len(i) == 4:
+                        if i[3].isalpha():
+                            trees[i[3]] = trees[i[2]].diff(i[1])
+                            print('Expression differentiated from '+ str(trees[i[2]])+' to: ' + str(trees[i[3]]))
+                        else:
+                            print('Tree names must be only letters')
+                    else:
+                        print('Wrong number of arguments. Expected: 3')                
                 
-            elif i[0] == "visualize":
-                if len(i) == 2:
-                    trees[i[1]].visualizeTree()
-                else:
-                    print('Wrong number of arguments. Expected: 1')
+                elif i[0] == "visualize":
+                    if len(i) == 2:
+                        trees[i[1]].visualizeTree()
+                    elif len(i) == 3 and i[2].endswith(('.svg', '.dot')):
+                        with open(i[2], 'w') as f:
+                            f.write(trees[i[1]].to_svg() if i[2].endswith('.svg') else trees[i[1]].to_dot())
+                        print('Tree written to ' + i[2])
+                    else:
+                        print('Wrong number of arguments. Expected: 1, or 2 to write an .svg or .dot file')
                 
-            elif i[0] == "print":
-                if len(i) == 2:
-                    print(str(trees[i[1]]))
-                else:
-                    print('Wrong number of arguments. Expected: 1')
+                elif i[0] == "print":
+                    if len(i) == 2:
+                        print(str(trees[i[1]]))
+                    else:
+                        print('Wrong number of arguments. Expected: 1')
 
-            elif i[0] == "evaluate":
-                print("".join(i[2:]))
-                x = trees[i[1]].evaluate(eval("".join(i[2:])))
-                print('Expression evaluated to: ' + str(x))
+                elif i[0] == "evaluate":
+                    print("".join(i[2:]))
+                    x = trees[i[1]].evaluate(eval("".join(i[2:])))
+                    print('Expression evaluated to: ' + str(x))
 
-            elif i[0] == "iseq":
-                if len(i) == 3:
-                    print(trees[i[1]] == trees[i[2]])
-                else:
-                    print('Wrong number of arguments. Expected: 2')
+                elif i[0] == "iseq":
+                    if len(i) == 3:
+                        print(trees[i[1]] == trees[i[2]])
+                    else:
+                        print('Wrong number of arguments. Expected: 2')
 
                 
+                elif i[0] == "profile":
+                    if len(i) == 1:
+                        print(instrumentation.report())
+                    elif i[1] in ("on", "off", "reset"):
+                        {"on": instrumentation.enable, "off": instrumentation.disable, "reset": instrumentation.reset}[i[1]]()
+                    else:
+                        print('Expected: profile [on|off|reset]')
+
+                elif i[0] == "stop":
+                    break
+
+                elif i[0] == "help":
+                    try:
+                        print(helpstr[i[1]])
+                    except:
+                        print('No help available for that subject.')
+                else:
+                    exec(h)
+                instrumentation.record('command ' + i[0], start)   # does nothing unless profiling is on
+        except KeyError:
+            print("Unknown tree name.")
+        except Exception as exc:
+            print(traceback.format_exc())
+
+
+def batch(lines, out):
+    " Executes new/diff/simplify/evaluate/print/iseq commands from lines, writing one JSON object per command to out "
+    for n, h in enumerate(lines, 1):
+        i = h.split()
+        if not i:
+            continue
+        result = {'line': n, 'command': i[0]}
+        start = time.perf_counter()
+        try:
+            if i[0] == "new" and len(i) >= 3 and i[1].isalpha():
+                trees[i[1]] = Expression.fromString("".join(i[2:]))
+                result['name'] = i[1]
+            elif i[0] == "simplify" and len(i) == 3 and i[2].isalpha():
+                trees[i[2]] = trees[i[1]].simplify()
+                result['name'] = i[2]
+            elif i[0] == "diff" and len(i) == 4 and i[3].isalpha():
+                trees[i[3]] = trees[i[2]].diff(i[1])
+                result['name'] = i[3]
+            elif i[0] == "evaluate" and len(i) >= 2:
+                x = trees[i[1]].evaluate(ast.literal_eval("".join(i[2:]) or '{}'))
+                if isinstance(x, int) or (isinstance(x, float) and math.isfinite(x)):
+                    result['result'] = x
+                else:
+                    result['result'] = str(x)   # partial evaluation gives a tree; inf and nan are not valid JSON numbers
+            elif i[0] == "print" and len(i) == 2:
+                result['result'] = str(trees[i[1]])
+            elif i[0] == "iseq" and len(i) == 3:
+                result['result'] = trees[i[1]] == trees[i[2]]
+            elif i[0] == "profile" and len(i) == 1:
+                result['result'] = instrumentation.snapshot()
+            elif i[0] == "profile" and len(i) == 2 and i[1] in ("on", "off", "reset"):
+                {"on": instrumentation.enable, "off": instrumentation.disable, "reset": instrumentation.reset}[i[1]]()
             elif i[0] == "stop":
                 break
-
-            elif i[0] == "help":
-                try:
-                    print(helpstr[i[1]])
-                except:
-                    print('No help available for that subject.')
             else:
-                exec(h)
-    except KeyError:
-        print("Unknown tree name.")
-    except Exception as exc:
-        print(traceback.format_exc())
+                result['error'] = 'Unknown command or wrong arguments'
+        except KeyError as exc:
+            result['error'] = 'Unknown tree name: %s' % exc
+        except Exception as exc:
+            result['error'] = '%s: %s' % (type(exc).__name__, exc)
+        instrumentation.record('command ' + i[0], start)
+        out.write(json.dumps(result, allow_nan=False) + '\n')
+
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Expression tree command processor')
+    parser.add_argument('--batch', metavar='FILE', nargs='?', const='-',
+                        help='run the commands in FILE (or stdin) without prompts and write JSON lines results')
+    parser.add_argument('--profile', action='store_true',
+                        help='count and time the tree operations and print a report to stderr at the end')
+    parser.add_argument('--store', metavar='DIR',
+                        help='keep the named trees in DIR, so they are still there after a restart')
+    args = parser.parse_args()
+    if args.store:
+        trees = TreeStore(args.store)       # same use as the dict, trees are read from disk when first used
+    if args.profile:
+        instrumentation.enable()
+    if args.batch is None:
+        interactive()
+    else:
+        stream = sys.stdin if args.batch == '-' else open(args.batch)
+        with stream, open(sys.stdout.fileno(), 'w', buffering=1 << 16, closefd=False) as out:   # block buffered, even on a terminal
+            batch(stream, out)
+    if args.profile:
+        print(instrumentation.report(), file=sys.stderr)